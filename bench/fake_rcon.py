@@ -0,0 +1,147 @@
+from typing import Callable, List, Optional, Tuple
+import socket
+import struct
+import threading
+import time
+import argparse
+
+# Stand-in for the RCON listener of a Minecraft server, for trying out src/rcon.py. Can also be
+# started by fake_server.py with --rcon-port so its commands go through RCON
+
+TYPE_RESPONSE = 0
+TYPE_COMMAND = 2
+TYPE_LOGIN = 3
+# The real server splits responses into packets of at most this many bytes
+MAX_BODY = 4096
+
+Handler = Callable[[str], str]
+
+
+def canned(command: str) -> str:
+    name = command.partition(' ')[0]
+    if name == 'list':
+        return 'There are 0/20 players online:'
+    if name == 'big':
+        # Spans several packets, to check the end of batch marker
+        return ''.join(f'line {i}\n' for i in range(2000))
+    return f'Ran {command}'
+
+
+class RconServer:
+    def __init__(self, port: int, password: str, handler: Handler = canned, delay: float = 0,
+                 drop_after: Optional[int] = None, close_idle: bool = False) -> None:
+        self.password = password
+        self.handler = handler
+        self.delay = delay
+        self.drop_after = drop_after
+        self.close_idle = close_idle
+        # Every command that was run, so a test can check none ran twice
+        self.ran: List[str] = []
+        self._lock = threading.Lock()
+        self._listener = socket.create_server(('127.0.0.1', port))
+        self.port = self._listener.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._listener.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _recv(self, conn: socket.socket) -> Optional[Tuple[int, int, str]]:
+        header = b''
+        while len(header) < 4:
+            part = conn.recv(4 - len(header))
+            if not part:
+                return None
+            header += part
+        length = struct.unpack('<i', header)[0]
+        payload = b''
+        while len(payload) < length:
+            part = conn.recv(length - len(payload))
+            if not part:
+                return None
+            payload += part
+        request_id, type = struct.unpack_from('<ii', payload)
+        return request_id, type, payload[8:-2].decode('utf-8', errors='replace')
+
+    def _send(self, conn: socket.socket, request_id: int, type: int, body: str) -> None:
+        data = body.encode('utf-8')
+        chunks = [data[i:i + MAX_BODY] for i in range(0, len(data), MAX_BODY)] or [b'']
+        for chunk in chunks:
+            payload = struct.pack('<ii', request_id, type) + chunk + b'\x00\x00'
+            conn.sendall(struct.pack('<i', len(payload)) + payload)
+
+    def _serve(self, conn: socket.socket) -> None:
+        with conn:
+            try:
+                self._session(conn)
+            except OSError:
+                # The client went away
+                pass
+
+    def _session(self, conn: socket.socket) -> None:
+        authed = False
+        while True:
+            try:
+                # Idle connections are closed between batches, like a server that restarted
+                if self.close_idle and authed:
+                    conn.settimeout(0.2)
+                packet = self._recv(conn)
+            except socket.timeout:
+                return
+            conn.settimeout(None)
+            if packet is None:
+                return
+            request_id, type, body = packet
+            if type == TYPE_LOGIN:
+                authed = body == self.password
+                self._send(conn, request_id if authed else -1, TYPE_COMMAND, '')
+                continue
+            if not authed:
+                return
+            if type != TYPE_COMMAND:
+                self._send(conn, request_id, TYPE_RESPONSE, f'Unknown request {type:x}')
+                continue
+            with self._lock:
+                self.ran.append(body)
+                count = len(self.ran)
+            if self.drop_after is not None and count > self.drop_after:
+                # Ran the command but the connection died before the answer went out
+                return
+            time.sleep(self.delay)
+            self._send(conn, request_id, TYPE_RESPONSE, self.handler(body))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Fake RCON listener for exercising the manager')
+    parser.add_argument('--port', type=int, default=25575)
+    parser.add_argument('--password', default='')
+    parser.add_argument('--delay', type=float, default=0, help='Seconds before each response')
+    parser.add_argument('--drop-after', type=int, help='Run but do not answer commands after this many')
+    parser.add_argument('--close-idle', action='store_true', help='Close connections that go quiet between batches')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = RconServer(args.port, args.password, canned, args.delay, args.drop_after, args.close_idle)
+    server.start()
+    print(f'Listening for RCON on 127.0.0.1:{server.port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
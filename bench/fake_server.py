@@ -0,0 +1,273 @@
+from typing import List, Optional, TextIO, Tuple
+import os
+import sys
+import zlib
+import time
+import random
+import struct
+import datetime
+import threading
+import argparse
+
+import fake_rcon
+
+# Stand-in for a Forge server. Writes its console to stdout and logs/latest.log in the same
+# format, answers the commands the manager sends and keeps a world of valid region files.
+# Run from the server directory, like the real jar
+
+SECTOR_SIZE = 4096
+HEADER_SIZE = 2 * SECTOR_SIZE
+REGION_CHUNKS = 1024
+SERVER = '[Server thread/INFO] [minecraft/DedicatedServer]'
+FML = '[Server thread/INFO] [FML]'
+# Share of the world per dimension
+DIMENSIONS = [('', 0.6), ('DIM-1', 0.2), ('DIM1', 0.2)]
+DEFAULT_CHUNK_KB = 4
+
+
+def _region_data(chunks: int, chunk_kb: int) -> bytes:
+    # Random chunk data compresses about as badly as real chunk NBT does after zlib
+    offsets = bytearray(SECTOR_SIZE)
+    timestamps = bytearray(SECTOR_SIZE)
+    body = bytearray()
+    sector = HEADER_SIZE // SECTOR_SIZE
+    now = int(time.time())
+    for index in random.sample(range(REGION_CHUNKS), min(chunks, REGION_CHUNKS)):
+        payload = zlib.compress(os.urandom(random.randint(chunk_kb * 512, chunk_kb * 1536)), 1)
+        chunk = struct.pack('>IB', len(payload) + 1, 2) + payload
+        count = (len(chunk) + SECTOR_SIZE - 1) // SECTOR_SIZE
+        struct.pack_into('>I', offsets, index * 4, (sector << 8) | count)
+        struct.pack_into('>I', timestamps, index * 4, now)
+        body += chunk + bytes(count * SECTOR_SIZE - len(chunk))
+        sector += count
+    return bytes(offsets + timestamps + body)
+
+
+def _region_dir(save_path: str, dim: str) -> str:
+    return os.path.join(save_path, dim, 'region') if dim else os.path.join(save_path, 'region')
+
+
+def _spiral(i: int) -> Tuple[int, int]:
+    x = z = 0
+    dx, dz = 0, -1
+    for _ in range(i):
+        if x == z or (x < 0 and x == -z) or (x > 0 and x == 1 - z):
+            dx, dz = -dz, dx
+        x, z = x + dx, z + dz
+    return x, z
+
+
+def make_world(save_path: str, size_mb: float, chunk_kb: int = DEFAULT_CHUNK_KB, players: int = 4) -> int:
+    # Returns the bytes written. Regions hold 256 chunks each
+    written = 0
+    for dim, share in DIMENSIONS:
+        region_dir = _region_dir(save_path, dim)
+        os.makedirs(region_dir, exist_ok=True)
+        target = size_mb * 1024 * 1024 * share
+        dim_written = 0
+        i = 0
+        # Regions spiral out from the origin like an explored world
+        while dim_written < target or i == 0:
+            x, z = _spiral(i)
+            data = _region_data(256, chunk_kb)
+            with open(os.path.join(region_dir, f'r.{x}.{z}.mca'), 'wb') as out:
+                out.write(data)
+            dim_written += len(data)
+            i += 1
+        written += dim_written
+    os.makedirs(os.path.join(save_path, 'playerdata'), exist_ok=True)
+    os.makedirs(os.path.join(save_path, 'data'), exist_ok=True)
+    for i in range(players):
+        with open(os.path.join(save_path, 'playerdata', f'00000000-0000-0000-0000-{i:012d}.dat'), 'wb') as out:
+            out.write(zlib.compress(os.urandom(2048)))
+    for name in ('level.dat', os.path.join('data', 'villages.dat')):
+        with open(os.path.join(save_path, name), 'wb') as out:
+            out.write(zlib.compress(os.urandom(1024)))
+    return written
+
+
+def dirty_regions(save_path: str, count: int) -> None:
+    # Rewrites one chunk in a few regions, the way a save only touches regions players were in
+    regions = [
+        os.path.join(_region_dir(save_path, dim), name)
+        for dim, _ in DIMENSIONS if os.path.isdir(_region_dir(save_path, dim))
+        for name in os.listdir(_region_dir(save_path, dim))
+    ]
+    for path in random.sample(regions, min(count, len(regions))):
+        with open(path, 'r+b') as region:
+            header = region.read(SECTOR_SIZE)
+            used = [i for i in range(REGION_CHUNKS) if struct.unpack_from('>I', header, i * 4)[0]]
+            if not used:
+                continue
+            entry = struct.unpack_from('>I', header, random.choice(used) * 4)[0]
+            offset = (entry >> 8) * SECTOR_SIZE
+            region.seek(offset)
+            length = struct.unpack('>I', region.read(4))[0]
+            region.seek(offset + 5)
+            region.write(os.urandom(length - 1))
+
+
+def read_level_name() -> str:
+    if os.path.isfile('server.properties'):
+        with open('server.properties') as props:
+            for line in props:
+                if line.startswith('level-name='):
+                    return line.strip().split('=', 1)[1]
+        return 'world'
+    with open('server.properties', 'w') as props:
+        props.write('level-name=world\n')
+    return 'world'
+
+
+class Console:
+    def __init__(self, echo: bool) -> None:
+        os.makedirs('logs', exist_ok=True)
+        if os.path.isfile('logs/latest.log'):
+            # The real server gzips the old log under the date, the name is all that matters here
+            stamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+            os.rename('logs/latest.log', f'logs/{stamp}.log')
+        self.log: TextIO = open('logs/latest.log', 'a', buffering=1)
+        self.echo = echo
+        # Messages of the command being run over RCON, which get them as the response
+        self.captured: Optional[List[str]] = None
+
+    def write(self, source: str, msg: str) -> None:
+        line = f'[{datetime.datetime.now().strftime("%H:%M:%S")}] {source}: {msg}\n'
+        if self.captured is not None:
+            self.captured.append(msg)
+        self.log.write(line)
+        if self.echo:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+    def server(self, msg: str) -> None:
+        self.write(SERVER, msg)
+
+
+def start(console: Console, save_path: str, args: argparse.Namespace) -> None:
+    step = args.startup / 5
+    console.write('[main/INFO] [LaunchWrapper]', 'Loading tweak class name net.minecraftforge.fml.common.launcher.FMLServerTweaker')
+    time.sleep(step)
+    console.server('Starting minecraft server version 1.12.2')
+    time.sleep(step)
+    console.write(FML, 'Forge Mod Loader version 14.23.5.2860 for Minecraft 1.12.2 loading')
+    console.write(FML, f'Loading {args.mods} mods')
+    for stage in ('PreInitialization', 'Initialization', 'PostInitialization'):
+        for i in range(args.mods):
+            seconds = step / 3 / max(1, args.mods)
+            time.sleep(seconds)
+            console.write(FML, f'Bar Step: {stage} - Mod {i} took {seconds:.3f}s')
+    console.server(f'Preparing level "{os.path.basename(save_path)}"')
+    if not os.path.isdir(save_path):
+        make_world(save_path, args.world_mb, args.chunk_kb)
+    for percent in range(0, 100, 25):
+        console.server(f'Preparing spawn area: {percent}%')
+        time.sleep(step / 4)
+    console.server(f'Done ({args.startup:.3f}s)! For help, type "help" or "?"')
+    for player in args.players:
+        console.server(f'{player} joined the game')
+
+
+def run_command(console: Console, command: str, save_path: str, args: argparse.Namespace) -> bool:
+    # Returns False on stop
+    name, _, rest = command.partition(' ')
+    if name == 'stop':
+        console.server('Stopping the server')
+        console.server('Saving players')
+        console.server('Saving worlds')
+        time.sleep(args.stop_delay)
+        return False
+    if name == 'list':
+        console.server(f'There are {len(args.players)}/20 players online:')
+        console.server(', '.join(args.players))
+    elif name == 'save-off':
+        console.server('Turned off world auto-saving')
+    elif name == 'save-on':
+        console.server('Turned on world auto-saving')
+    elif name == 'save-all':
+        console.server('Saving...')
+        dirty_regions(save_path, args.dirty)
+        console.server('Saved the world')
+    elif command == 'forge tps':
+        console.server('Dim  0 (overworld) : Mean tick time: 3.210 ms. Mean TPS: 20.000')
+        console.server(f'Overall : Mean tick time: {args.mspt:.3f} ms. Mean TPS: {min(20.0, 1000 / args.mspt):.3f}')
+    elif name == 'say':
+        console.server(f'[Server] {rest}')
+    elif name in ('tell', 'give', 'effect', 'execute', 'summon', 'playsound'):
+        console.server(f'Ran {command}')
+    else:
+        console.server('Unknown command. Try /help for a list of commands')
+    return True
+
+
+def crash(console: Console, delay: float) -> None:
+    time.sleep(delay)
+    console.write('[Server thread/ERROR] [minecraft/MinecraftServer]', 'Encountered an unexpected exception')
+    os._exit(1)
+
+
+def serve_rcon(console: Console, save_path: str, args: argparse.Namespace) -> fake_rcon.RconServer:
+    # Commands from the console and RCON run one at a time, like on the server thread
+    lock = threading.Lock()
+
+    def handle(command: str) -> str:
+        with lock:
+            console.captured = []
+            try:
+                running = run_command(console, command.lstrip('/'), save_path, args)
+                response = '\n'.join(console.captured)
+            finally:
+                console.captured = None
+        if not running:
+            os._exit(0)
+        return response
+
+    server = fake_rcon.RconServer(args.rcon_port, args.rcon_password, handle)
+    server.start()
+    return server
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Fake Forge server for exercising the manager')
+    parser.add_argument('--world-mb', type=float, default=64, help='World size to generate if there is none')
+    parser.add_argument('--chunk-kb', type=int, default=DEFAULT_CHUNK_KB, help='Average chunk size')
+    parser.add_argument('--startup', type=float, default=1, help='Seconds from launch to Done')
+    parser.add_argument('--mods', type=int, default=10, help='Mods reported by the loader')
+    parser.add_argument('--players', nargs='*', default=[], help='Players that join after startup')
+    parser.add_argument('--dirty', type=int, default=4, help='Regions rewritten by each save-all')
+    parser.add_argument('--mspt', type=float, default=5, help='Mean tick time reported by forge tps')
+    parser.add_argument('--stop-delay', type=float, default=0.5, help='Seconds spent saving on stop')
+    parser.add_argument('--no-echo', action='store_true', help='Only write the log, not stdout')
+    parser.add_argument('--hang-after', type=int, help='Stop answering after this many commands')
+    parser.add_argument('--rcon-port', type=int, help='Also take commands over RCON on this port')
+    parser.add_argument('--rcon-password', default='')
+    parser.add_argument('--crash-after', type=float, help='Exit with an error this many seconds after Done')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    console = Console(not args.no_echo)
+    save_path = read_level_name()
+    start(console, save_path, args)
+    if args.rcon_port is not None:
+        serve_rcon(console, save_path, args)
+    if args.crash_after is not None:
+        threading.Thread(target=crash, args=(console, args.crash_after), daemon=True).start()
+
+    commands = 0
+    for line in sys.stdin:
+        command = line.strip().lstrip('/')
+        if not command:
+            continue
+        commands += 1
+        if args.hang_after is not None and commands > args.hang_after:
+            # Like a deadlocked server thread, the process stays up but nothing answers
+            while True:
+                time.sleep(60)
+        if not run_command(console, command, save_path, args):
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+from typing import TypedDict, List, Optional, Dict, Tuple
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import shutil
+import logging
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+import backup
+import fake_server
+from instance import Instance, LATEST_LOG
+from log_follower import file_identity
+from readiness import Readiness
+from server import Server, LIST_MSG
+from server_config import DEFAULT_CONFIG, Config, instance_dir
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_server.py')
+PLAYERS = ['Alice', 'Bob', 'Carol']
+# Its own control socket, so a manager running from this checkout is left alone
+INSTANCE = 'bench'
+MB = 1024 * 1024
+# Changes smaller than this are shown as noise when comparing runs
+NOISE = 0.05
+
+
+class Result(TypedDict):
+    world_mb: float  # As requested, the generated world is a bit bigger
+    mode: str
+    log_source: str
+    startup: float  # Launch to Done, seconds
+    command_p50: float
+    command_p95: float
+    command_max: float
+    save_off: float  # Time the world was not being saved
+    backup: float  # Capture and finalize
+    throughput_mb: float  # Generated world MB per second of backup
+    second_backup: Optional[float]  # After a few regions changed, with --second-backup
+    stop: float
+
+
+# Lower is better for everything but throughput
+COLUMNS = [
+    ('startup', 's'), ('command_p50', 'ms'), ('command_p95', 'ms'), ('command_max', 'ms'),
+    ('save_off', 's'), ('backup', 's'), ('throughput_mb', 'MB/s'), ('second_backup', 's'), ('stop', 's')
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def world_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def bench_config(root: str, mode: str, args: argparse.Namespace) -> Config:
+    config: Config = copy.deepcopy(DEFAULT_CONFIG)
+    server_path = os.path.join(root, 'server')
+    config.update({
+        'name': INSTANCE,
+        'server_path': server_path,
+        'save_path': os.path.join(server_path, 'world'),
+        'start_command': [
+            sys.executable, FAKE_SERVER, '--startup', str(args.startup), '--mods', str(args.mods),
+            '--dirty', str(args.dirty), '--players', *PLAYERS
+        ],
+        'log_source': args.log_source,
+        'backup_path': os.path.join(root, f'backups-{mode}'),
+        'backup_mode': mode,
+        'backup_verify_mb_per_hour': 0,
+        'tps_interval': 0
+    })
+    return config
+
+
+def wait_next_minute() -> None:
+    # Backups are named by the minute, a second one in the same minute would replace the first
+    now = datetime.datetime.now()
+    time.sleep(60 - now.second - now.microsecond / 1e6 + 0.1)
+
+
+def timed_backup(minecraft: Server) -> Tuple[float, float]:
+    # Returns how long saving was off and how long the whole backup took
+    start = time.perf_counter()
+    minecraft.save_game()
+    save_off = time.perf_counter() - start
+    minecraft.backup_worker.wait_idle()
+    elapsed = time.perf_counter() - start
+    status = minecraft.backup_worker.status()
+    if status['last_error']:
+        raise Exception(f'Backup failed: {status["last_error"]}')
+    return save_off, elapsed
+
+
+def run_once(config: Config, world_mb: float, world_bytes: int, args: argparse.Namespace) -> Result:
+    # The same steps as Instance.lifetime, timed one by one
+    instance = Instance(config)
+    stale = file_identity(os.path.join(config['server_path'], LATEST_LOG))
+    launched = time.monotonic()
+    process = instance.start_game()
+    logs = instance.open_logs(process, stale)
+    readiness = Readiness(logs, process, launched, config['name'])
+    logs.start()
+    minecraft: Optional[Server] = None
+    try:
+        minecraft = Server(config, process, logs)
+        startup = readiness.wait(config['startup_timeout'])
+
+        rtts = []
+        for _ in range(args.commands):
+            start = time.perf_counter()
+            minecraft.send_command('list', LIST_MSG, True)
+            rtts.append(time.perf_counter() - start)
+
+        save_off, backup_seconds = timed_backup(minecraft)
+        second = None
+        if args.second_backup:
+            wait_next_minute()
+            second = timed_backup(minecraft)[1]
+
+        start = time.perf_counter()
+        minecraft.stop()
+        stop = time.perf_counter() - start
+    except Exception:
+        process.kill()
+        if minecraft:
+            minecraft.stop()
+        raise
+    finally:
+        logs.stop()
+
+    return {
+        'world_mb': world_mb,
+        'mode': config['backup_mode'],
+        'log_source': config['log_source'],
+        'startup': startup,
+        'command_p50': percentile(rtts, 0.5) * 1000,
+        'command_p95': percentile(rtts, 0.95) * 1000,
+        'command_max': max(rtts, default=0) * 1000,
+        'save_off': save_off,
+        'backup': backup_seconds,
+        'throughput_mb': world_bytes / MB / backup_seconds,
+        'second_backup': second,
+        'stop': stop
+    }
+
+
+def _format(value: Optional[float]) -> str:
+    return '-' if value is None else f'{value:.3f}' if value < 10 else f'{value:.1f}'
+
+
+def _change(key: str, value: Optional[float], before: Optional[float]) -> str:
+    if value is None or not before:
+        return ''
+    change = (value - before) / before
+    if abs(change) < NOISE:
+        return ' (=)'
+    better = change > 0 if key == 'throughput_mb' else change < 0
+    return f' ({change:+.0%} {"better" if better else "worse"})'
+
+
+def print_results(results: List[Result], baseline: List[Result]) -> None:
+    previous: Dict[tuple, Result] = {(r['world_mb'], r['mode'], r['log_source']): r for r in baseline}
+    for result in results:
+        print(f'{result["mode"]} backup of {result["world_mb"]} MB world, {result["log_source"]} log')
+        before = previous.get((result['world_mb'], result['mode'], result['log_source']))
+        for key, unit in COLUMNS:
+            change = _change(key, result[key], before[key]) if before else ''
+            print(f'  {key:<14}{_format(result[key]):>10} {unit:<5}{change}')
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the manager against the fake server')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[64, 256], help='World sizes in MB')
+    parser.add_argument('--modes', nargs='+', default=[backup.MODE_INCREMENTAL, backup.MODE_COPY,
+                                                       backup.MODE_CHUNKED, backup.MODE_ARCHIVE])
+    parser.add_argument('--log-source', choices=['file', 'stdout'], default='file')
+    parser.add_argument('--commands', type=int, default=200, help='list commands sent for the round trip numbers')
+    parser.add_argument('--startup', type=float, default=1, help='Seconds the fake server takes to start')
+    parser.add_argument('--mods', type=int, default=10)
+    parser.add_argument('--dirty', type=int, default=4, help='Regions changed by each save-all')
+    parser.add_argument('--second-backup', action='store_true',
+                        help='Also time a backup after a few regions changed. Waits for the next minute')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare against')
+    parser.add_argument('--keep', action='store_true', help='Keep the worlds and backups')
+    parser.add_argument('--verbose', action='store_true', help='Show the manager log')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    os.makedirs(instance_dir(INSTANCE), exist_ok=True)
+    baseline: List[Result] = []
+    if args.compare:
+        with open(args.compare) as input:
+            baseline = json.load(input)
+
+    results: List[Result] = []
+    for size in args.sizes:
+        root = tempfile.mkdtemp(prefix='mc-bench-')
+        try:
+            save_path = os.path.join(root, 'server', 'world')
+            print(f'Generating a {size:.0f} MB world in {root}')
+            fake_server.make_world(save_path, size)
+            world_bytes = world_size(save_path)
+            print(f'Generated {world_bytes / MB:.1f} MB')
+            for mode in args.modes:
+                results.append(run_once(bench_config(root, mode, args), size, world_bytes, args))
+                print_results(results[-1:], baseline)
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=4)
+
+
+if __name__ == '__main__':
+    main()
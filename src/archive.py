@@ -0,0 +1,113 @@
+from typing import Dict, List, Tuple, Callable, Iterator
+import os
+import tarfile
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_XZ = 'xz'
+
+EXTENSIONS = {
+    COMPRESSION_ZSTD: '.tar.zst',
+    COMPRESSION_GZIP: '.tar.gz',
+    COMPRESSION_XZ: '.tar.xz'
+}
+
+LEVELS = {
+    COMPRESSION_ZSTD: (1, 22),
+    COMPRESSION_GZIP: (1, 9),
+    COMPRESSION_XZ: (0, 9)
+}
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_compression(compression: str) -> str:
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        logger.warning('zstandard is not installed, falling back to gzip')
+        return COMPRESSION_GZIP
+    if compression not in EXTENSIONS:
+        raise Exception(f'Unknown backup compression: {compression}')
+    return compression
+
+
+def dimension_groups(world_dir: str) -> Dict[str, List[str]]:
+    # One archive per dimension. The overworld is everything that is not a DIM* folder
+    name = os.path.basename(os.path.normpath(world_dir))
+    groups: Dict[str, List[str]] = {name: []}
+    for entry in sorted(os.listdir(world_dir)):
+        if entry.startswith('DIM') and os.path.isdir(os.path.join(world_dir, entry)):
+            groups[f'{name}_{entry}'] = [entry]
+        else:
+            groups[name].append(entry)
+    return groups
+
+
+def _write_archive(job: Tuple[str, List[str], str, str, int]) -> int:
+    world_dir, entries, dst, compression, level = job
+    low, high = LEVELS[compression]
+    level = max(low, min(high, level))
+    name = os.path.basename(os.path.normpath(world_dir))
+    tmp = f'{dst}.tmp'
+
+    def add_all(tar: tarfile.TarFile) -> None:
+        for entry in entries:
+            tar.add(os.path.join(world_dir, entry), arcname=os.path.join(name, entry))
+
+    if compression == COMPRESSION_ZSTD:
+        with open(tmp, 'wb') as raw:
+            writer = zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False)
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                add_all(tar)
+            writer.close()
+    elif compression == COMPRESSION_XZ:
+        with tarfile.open(tmp, 'w:xz', preset=level) as tar:
+            add_all(tar)
+    else:
+        with tarfile.open(tmp, 'w:gz', compresslevel=level) as tar:
+            add_all(tar)
+
+    os.replace(tmp, dst)
+    return os.path.getsize(dst)
+
+
+def write_archives(world_dir: str, dst_dir: str, compression: str, level: int, workers: int) -> int:
+    compression = resolve_compression(compression)
+    os.makedirs(dst_dir, exist_ok=True)
+    jobs = [
+        (world_dir, entries, os.path.join(dst_dir, group + EXTENSIONS[compression]), compression, level)
+        for group, entries in dimension_groups(world_dir).items() if entries
+    ]
+
+    # spawn so the workers do not inherit locks held by the manager's other threads
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context) as pool:
+        return sum(pool.map(_write_archive, jobs))
+
+
+def _members(tar: tarfile.TarFile, wanted: Callable[[str], bool]) -> Iterator[Tuple[str, bytes]]:
+    for member in tar:
+        name = os.path.normpath(member.name)
+        if member.isfile() and wanted(name):
+            yield name, tar.extractfile(member).read()
+
+
+def read_archive(path: str, wanted: Callable[[str], bool] = lambda _: True) -> Iterator[Tuple[str, bytes]]:
+    # Archives are streamed front to back, one member in memory at a time
+    if path.endswith(EXTENSIONS[COMPRESSION_ZSTD]):
+        if zstandard is None:
+            raise Exception(f'zstandard is needed to read {path}')
+        with open(path, 'rb') as raw:
+            reader = zstandard.ZstdDecompressor().stream_reader(raw)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                yield from _members(tar, wanted)
+        return
+    with tarfile.open(path, 'r|*') as tar:
+        yield from _members(tar, wanted)
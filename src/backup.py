@@ -1,31 +1,65 @@
-from typing import TypedDict, List
+from typing import TypedDict, List, Optional, Dict, Tuple, Hashable
 import os
-import json
 import shutil
+import hashlib
 import datetime
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
 
-METADATA_FILE = 'backups.json'
-SAVE_COUNT = 5
-DAY_ROLL_COUNT = 5
+import chunk_store
+import archive
+import metrics
+from copy_engine import CopyEngine, TokenBucket, supports_reflink, CHUNK_SIZE
+from registry import BackupRegistry, BackupDay, BackupRecord, FileRecord
+from retention import RetentionPolicy, DEFAULT_RETENTION, Footprint, select
 
-class BackupMetadata(TypedDict):
-    path: str  # local to dir
-    time: int
+MODE_COPY = 'copy'
+MODE_INCREMENTAL = 'incremental'
+MODE_CHUNKED = 'chunked'
+MODE_ARCHIVE = 'archive'
 
-class BackupDay(TypedDict):
-    path: str  # local to BACKUP_PATH
-    time: int
-    backups: List[BackupMetadata]
+STAGING_DIR = 'staging'
+MB = 1024 * 1024
 
-class Registry(TypedDict):
-    backups: List[BackupDay]
+logger = logging.getLogger(__name__)
 
+class ArchiveSettings(TypedDict):
+    compression: str  # zstd, gzip, xz
+    level: int
+    workers: int
 
-DEFAULT_REGISTRY: Registry = {
-    'backups': []
+
+DEFAULT_ARCHIVE_SETTINGS: ArchiveSettings = {
+    'compression': archive.COMPRESSION_ZSTD,
+    'level': 3,
+    'workers': 4
 }
 
-_registry: Registry = DEFAULT_REGISTRY
+_registries: Dict[str, BackupRegistry] = {}
+_policies: Dict[str, RetentionPolicy] = {}
+_lock = threading.RLock()
+# Per backup path, since each can be on a different filesystem
+_engines: Dict[str, CopyEngine] = {}
+_copy_threads: Dict[str, int] = {}
+# The server each backup path belongs to, for labelling metrics
+_names: Dict[str, str] = {}
+# Shared by every backup path so servers backing up together stay under one limit
+_bucket: Optional[TokenBucket] = None
+# Held from save-off to save-on, so only one server at a time has saving off and its world
+# being copied
+snapshot_lock = threading.Lock()
+# Finalizing writes chunks or archives and hashes files, one server at a time does that as well
+finalize_lock = threading.Lock()
+
+_capture_seconds = metrics.histogram('backup_capture_seconds', 'Time spent copying the world while saving is off')
+_finalize_seconds = metrics.histogram('backup_finalize_seconds', 'Time spent finishing a backup in the background')
+_prune_seconds = metrics.histogram('backup_prune_seconds', 'Time spent pruning old backups')
+_bytes_written = metrics.counter('backup_bytes_written_total', 'Bytes written to the backup directory')
+_pruned = metrics.counter('backup_pruned_total', 'Backups deleted by the retention policy')
+_hash_seconds = metrics.histogram('backup_hash_seconds', 'Time spent hashing files the capture could not hash')
+_last_bytes = metrics.gauge('backup_last_bytes_written', 'Bytes written by the most recent backup')
+_capture_throughput = metrics.gauge('backup_capture_bytes_per_second', 'Copy throughput of the most recent capture')
 
 
 def _get_current_date_index() -> int:
@@ -34,72 +68,406 @@ def _get_current_date_index() -> int:
     return (today - START_DATE).days
     
 
+def get_registry(backup_path: str) -> BackupRegistry:
+    with _lock:
+        registry = _registries.get(backup_path)
+        if registry is None:
+            registry = BackupRegistry(backup_path)
+            _registries[backup_path] = registry
+        return registry
+
+
 def _find_or_create_day_backup(backup_path: str) -> BackupDay:
-    global _registry
-
-    index = _get_current_date_index()
-    for day in _registry['backups']:
-        if day['time'] == index:
-            return day
-    day: BackupDay = {
-        'backups': [],
-        'path': datetime.date.today().strftime("%Y-%m-%d"),
-        'time': index
-    }
-    _registry['backups'].append(day)
+    day = get_registry(backup_path).find_or_create_day(
+        _get_current_date_index(),
+        datetime.date.today().strftime("%Y-%m-%d")
+    )
     path = os.path.join(backup_path, day['path'])
     if not os.path.isdir(path):
         os.mkdir(path)
     return day
 
 
-def take_backup(save_path: str, backup_path: str):
-    day = _find_or_create_day_backup(backup_path)
-    now = datetime.datetime.now()
-    backup: BackupMetadata = {
-        'path': now.time().strftime('%H-%M'),
-        'time': int(now.timestamp())
+def _latest_backup_dir(backup_path: str) -> Optional[str]:
+    latest = get_registry(backup_path).latest_backup(complete_only=True)
+    if not latest:
+        return None
+    return os.path.join(backup_path, latest['day_path'], latest['path'])
+
+
+def _unchanged(src: str, prev: str) -> bool:
+    try:
+        a = os.stat(src)
+        b = os.stat(prev)
+    except OSError:
+        return False
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+class _CopyPool:
+    # Copies files on a thread pool, hashing those that are read into memory to be copied.
+    # File I/O and hashlib release the GIL, so threads do run in parallel
+    def __init__(self, backup_path: str, root: str, previous: Dict[str, FileRecord]) -> None:
+        self.root = root  # Record paths are relative to this, so they start with the world name
+        self.previous = previous
+        self._engine = _engines.get(backup_path) or CopyEngine(bucket=_bucket)
+        self._pool = ThreadPoolExecutor(max(1, _copy_threads.get(backup_path, 4)))
+        self._jobs: List[Future] = []
+
+    def copy(self, src: str, dst: str) -> None:
+        self._jobs.append(self._pool.submit(self._copy, src, dst))
+
+    def keep(self, src: str, dst: str) -> None:
+        # dst is already the same as src, e.g. hard linked to the previous backup
+        self._jobs.append(self._pool.submit(self._keep, src, dst))
+
+    def _record(self, src: str, dst: str, digest: Optional[str]) -> FileRecord:
+        stat = os.stat(dst)
+        return {
+            'path': os.path.relpath(src, self.root),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': digest
+        }
+
+    def _copy(self, src: str, dst: str) -> Tuple[int, FileRecord]:
+        # Clones and zero copy transfers are hashed by finalize, reading them here would undo
+        # what they save while saving is off
+        digest = hashlib.sha256()
+        copied, hashed = self._engine.copy_file(src, dst, digest)
+        return copied, self._record(src, dst, digest.hexdigest() if hashed else None)
+
+    def _keep(self, src: str, dst: str) -> Tuple[int, FileRecord]:
+        # Unknown hashes are left for finalize so saving is not off any longer than needed
+        record = self._record(src, dst, None)
+        prev = self.previous.get(record['path'])
+        if prev and prev['size'] == record['size'] and prev['mtime'] == record['mtime']:
+            record['hash'] = prev['hash']
+        return 0, record
+
+    def finish(self) -> Tuple[int, List[FileRecord]]:
+        try:
+            results = [job.result() for job in self._jobs]
+        finally:
+            self._pool.shutdown()
+        return sum(copied for copied, _ in results), [record for _, record in results]
+
+
+def _copy_tree(src_dir: str, dst_dir: str, pool: _CopyPool) -> None:
+    shutil.copytree(src_dir, dst_dir, copy_function=pool.copy, dirs_exist_ok=True)
+
+
+def _incremental_copy(src_dir: str, dst_dir: str, link_dest: Optional[str], pool: _CopyPool) -> None:
+    # Same idea as rsync --link-dest: files that match the previous snapshot are hard linked
+    # to it so only changed files take time and disk space. Deleting a snapshot then only
+    # frees the files that no other snapshot links to
+    for root, _, files in os.walk(src_dir):
+        rel = os.path.relpath(root, src_dir)
+        out_dir = os.path.normpath(os.path.join(dst_dir, rel))
+        os.makedirs(out_dir, exist_ok=True)
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(out_dir, name)
+            prev = os.path.join(link_dest, rel, name) if link_dest else None
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if prev and _unchanged(src, prev):
+                try:
+                    os.link(prev, dst)
+                    pool.keep(src, dst)
+                    continue
+                except OSError:
+                    pass
+            pool.copy(src, dst)
+
+
+def _backup_dirs(backup_path: str) -> List[str]:
+    return [
+        os.path.join(backup_path, backup['day_path'], backup['path'])
+        for backup in get_registry(backup_path).backups()
+    ]
+
+
+def throttle(size: int) -> None:
+    # Counts I/O done outside of a CopyEngine against the shared rate limit
+    bucket = _bucket
+    while bucket and size > 0:
+        # The bucket never holds more than a chunk's worth beyond the rate
+        amount = min(size, CHUNK_SIZE)
+        bucket.consume(amount)
+        size -= amount
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input:
+        for block in iter(lambda: input.read(1024 * 1024), b''):
+            throttle(len(block))
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fill_hashes(backup_path: str, world_dir: str, records: List[FileRecord]) -> None:
+    # On the same number of threads as the capture, hashlib and reads release the GIL
+    missing = [record for record in records if record['hash'] is None]
+    if not missing:
+        return
+    paths = [os.path.join(os.path.dirname(world_dir), record['path']) for record in missing]
+    with ThreadPoolExecutor(max(1, _copy_threads.get(backup_path, 4))) as pool:
+        for record, digest in zip(missing, pool.map(_hash_file, paths)):
+            record['hash'] = digest
+
+
+def _drop_cache(backup_path: str, world_dir: str, records: List[FileRecord]) -> None:
+    # Done after the capture so saving is not off while the copies are flushed
+    engine = _engines.get(backup_path)
+    if not engine:
+        return
+    for record in records:
+        try:
+            engine.drop_cache(os.path.join(os.path.dirname(world_dir), record['path']))
+        except OSError as e:
+            logger.warning(f'Failed to drop cached pages of {record["path"]}: {e}')
+
+
+class Snapshot(TypedDict):
+    save_path: str
+    backup_path: str
+    mode: str
+    backup_dir: str
+    backup_id: int
+    link_dest: Optional[str]  # Previous backup dir, if any
+    archive: Optional[ArchiveSettings]
+    written: int
+    files: List[FileRecord]
+
+
+def _staging_dir(backup_path: str, save_path: str) -> str:
+    return os.path.join(backup_path, STAGING_DIR, os.path.basename(save_path))
+
+
+def _mirror(src_dir: str, dst_dir: str, pool: _CopyPool) -> None:
+    # Keeps dst_dir an exact copy of src_dir while only copying files that changed
+    seen = set()
+    for root, _, files in os.walk(src_dir):
+        rel = os.path.relpath(root, src_dir)
+        out_dir = os.path.normpath(os.path.join(dst_dir, rel))
+        os.makedirs(out_dir, exist_ok=True)
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(out_dir, name)
+            seen.add(dst)
+            if _unchanged(src, dst):
+                pool.keep(src, dst)
+            else:
+                pool.copy(src, dst)
+    for root, _, files in os.walk(dst_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if path not in seen:
+                os.remove(path)
+
+
+def capture(save_path: str, backup_path: str, mode: str = MODE_COPY,
+            archive_settings: Optional[ArchiveSettings] = None) -> Snapshot:
+    registry = get_registry(backup_path)
+    with _lock:
+        link_dest: Optional[str] = None
+        if mode in (MODE_INCREMENTAL, MODE_CHUNKED):
+            link_dest = _latest_backup_dir(backup_path)
+
+        day = _find_or_create_day_backup(backup_path)
+        now = datetime.datetime.now()
+        path = now.time().strftime('%H-%M')
+        # A second backup in the same minute reuses the directory and the record
+        backup_id = registry.add_backup(day['id'], path, int(now.timestamp()), mode)
+        backup_dir = os.path.join(backup_path, day['path'], path)
+        if not os.path.isdir(backup_dir):
+            os.mkdir(backup_dir)
+        if link_dest and os.path.isdir(link_dest) and os.path.samefile(backup_dir, link_dest):
+            link_dest = None
+
+    snapshot: Snapshot = {
+        'save_path': save_path,
+        'backup_path': backup_path,
+        'mode': mode,
+        'backup_dir': backup_dir,
+        'backup_id': backup_id,
+        'link_dest': link_dest,
+        'archive': archive_settings,
+        'written': 0,
+        'files': []
     }
-    day['backups'].append(backup)
-    day_path = os.path.join(backup_path, day['path'])
-    backup_dir = os.path.join(day_path, backup['path'])
-    if not os.path.isdir(backup_dir):
-        os.mkdir(backup_dir)
     dst_path = os.path.join(backup_dir, os.path.basename(save_path))
-    shutil.copytree(save_path, dst_path, dirs_exist_ok=True)
+    start = datetime.datetime.now().timestamp()
+    latest = registry.latest_backup(complete_only=True)
+    pool = _CopyPool(
+        backup_path,
+        os.path.dirname(os.path.normpath(save_path)),
+        registry.files(latest['id']) if latest else {}
+    )
+    instance = _names.get(backup_path, '')
+    with _capture_seconds.time(mode=mode, instance=instance):
+        try:
+            if mode == MODE_INCREMENTAL:
+                prev = os.path.join(link_dest, os.path.basename(save_path)) if link_dest else None
+                _incremental_copy(save_path, dst_path, prev, pool)
+            elif mode in (MODE_CHUNKED, MODE_ARCHIVE):
+                _mirror(save_path, _staging_dir(backup_path, save_path), pool)
+            else:
+                _copy_tree(save_path, dst_path, pool)
+        finally:
+            copied, snapshot['files'] = pool.finish()
+    elapsed = datetime.datetime.now().timestamp() - start
+    rate = copied / elapsed if elapsed > 0 else 0
+    _capture_throughput.set(rate, instance=instance)
+    logger.info(f'Captured {copied / MB:.1f} MB in {elapsed:.2f}s ({rate / MB:.1f} MB/s)')
+    # Staging copies are not kept, only what finalize writes counts for those modes
+    if mode not in (MODE_CHUNKED, MODE_ARCHIVE):
+        _bytes_written.inc(copied, instance=instance)
+        _last_bytes.set(copied, instance=instance)
+        snapshot['written'] = copied
+    return snapshot
+
+
+def finalize(snapshot: Snapshot) -> None:
+    if not finalize_lock.acquire(blocking=False):
+        logger.info('Waiting for another server to finish its backup')
+        finalize_lock.acquire()
+    try:
+        with _finalize_seconds.time(mode=snapshot['mode'], instance=_names.get(snapshot['backup_path'], '')):
+            _finalize(snapshot)
+    finally:
+        finalize_lock.release()
+
+
+def _finalize(snapshot: Snapshot) -> None:
+    backup_path = snapshot['backup_path']
+    instance = _names.get(backup_path, '')
+    staging_dir = _staging_dir(backup_path, snapshot['save_path'])
+    written = snapshot['written']
+    if snapshot['mode'] == MODE_CHUNKED:
+        link_dest = snapshot['link_dest']
+        previous = chunk_store.load_manifest(link_dest) if link_dest else None
+        written = chunk_store.write_snapshot(
+            staging_dir,
+            snapshot['backup_dir'],
+            os.path.join(backup_path, chunk_store.STORE_DIR),
+            previous
+        )
+    elif snapshot['mode'] == MODE_ARCHIVE:
+        settings = snapshot['archive'] or DEFAULT_ARCHIVE_SETTINGS
+        written = archive.write_archives(
+            staging_dir,
+            snapshot['backup_dir'],
+            settings['compression'],
+            settings['level'],
+            settings['workers']
+        )
+    if snapshot['mode'] in (MODE_CHUNKED, MODE_ARCHIVE):
+        _bytes_written.inc(written, instance=instance)
+        _last_bytes.set(written, instance=instance)
+        world_dir = staging_dir
+    else:
+        world_dir = os.path.join(snapshot['backup_dir'], os.path.basename(snapshot['save_path']))
+
+    with _hash_seconds.time(mode=snapshot['mode'], instance=instance):
+        _fill_hashes(backup_path, world_dir, snapshot['files'])
+    _drop_cache(backup_path, world_dir, snapshot['files'])
+    get_registry(backup_path).complete_backup(snapshot['backup_id'], written, snapshot['files'])
 
     prune_and_save(backup_path)
 
 
+def take_backup(save_path: str, backup_path: str, mode: str = MODE_COPY,
+                archive_settings: Optional[ArchiveSettings] = None):
+    finalize(capture(save_path, backup_path, mode, archive_settings))
+
+
+def _footprint(backup_path: str, backups: List[BackupRecord]) -> Footprint:
+    # Files are counted by inode, so hard links into older backups are only counted once, and
+    # chunked backups add the store blobs their manifest uses. Measured up front so the walk
+    # does not hold _lock, a backup finished since then falls back to the bytes it added
+    store_dir = os.path.join(backup_path, chunk_store.STORE_DIR)
+    blob_sizes: Dict[str, int] = {}
+    usages: Dict[int, Dict[Hashable, int]] = {}
+    for backup in backups:
+        usage: Dict[Hashable, int] = {}
+        backup_dir = os.path.join(backup_path, backup['day_path'], backup['path'])
+        for root, _, files in os.walk(backup_dir):
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                usage[(st.st_dev, st.st_ino)] = st.st_blocks * 512
+        if backup['mode'] == MODE_CHUNKED:
+            usage.update(chunk_store.blob_usage(backup_dir, store_dir, blob_sizes))
+        usages[backup['id']] = usage
+    return lambda backup: usages.get(backup['id'], {backup['id']: backup['bytes']})
+
+
 def prune_and_save(backup_path: str):
-    global _registry
+    with _prune_seconds.time(instance=_names.get(backup_path, '')):
+        _prune_and_save(backup_path)
+
 
-    # Prune days first
-    _registry['backups'] = sorted(_registry['backups'], key=lambda b: b['time'], reverse=True)
-    for day in _registry['backups'][DAY_ROLL_COUNT:]:
-        shutil.rmtree(os.path.join(backup_path, day['path']))
-    _registry['backups'] = _registry['backups'][0:DAY_ROLL_COUNT]
+def _prune_and_save(backup_path: str):
+    registry = get_registry(backup_path)
+    policy = _policies.get(backup_path, DEFAULT_RETENTION)
 
-    # Prune backups in each day
-    for day in _registry['backups']:
-        day['backups'] = sorted(day['backups'], key=lambda b: b['time'], reverse=True)
-        for backup in day['backups'][SAVE_COUNT:]:
-            path = os.path.join(backup_path, day['path'])
-            shutil.rmtree(os.path.join(path, backup['path']))
-        day['backups'] = day['backups'][0:SAVE_COUNT]
+    # Rows go first, in one transaction, so a crash part way through never leaves a record
+    # pointing at a deleted directory. Directories are removed after the lock is released so
+    # a capture does not wait on them
+    footprint = None
+    if policy['max_total_gb'] > 0:
+        footprint = _footprint(backup_path, [b for b in registry.backups() if b['complete']])
+    with _lock:
+        backups = registry.backups()
+        keep = select(backups, policy, footprint)
+        newest = max((b['time'] for b in backups if b['id'] in keep), default=0)
+        # Incomplete backups older than the newest complete one were interrupted
+        doomed = [b for b in backups if b['id'] not in keep and (b['complete'] or b['time'] < newest)]
+        registry.delete_backups(b['id'] for b in doomed)
+        empty_days = registry.empty_days()
+        for day in empty_days:
+            registry.delete_day(day['id'])
+        remaining = _backup_dirs(backup_path)
 
-    # Write metadata
-    with open(os.path.join(backup_path, METADATA_FILE), 'w') as out:
-        out.write(json.dumps(_registry, indent=4))
+    for backup in doomed:
+        shutil.rmtree(os.path.join(backup_path, backup['day_path'], backup['path']), ignore_errors=True)
+    for day in empty_days:
+        shutil.rmtree(os.path.join(backup_path, day['path']), ignore_errors=True)
+    if doomed:
+        _pruned.inc(len(doomed), instance=_names.get(backup_path, ''))
+        logger.info(f'Pruned {len(doomed)} backups, keeping {len(keep)}')
 
+    # Hard linked files are freed by the filesystem once no backup links them, chunks need
+    # to be dropped here once no remaining manifest references them
+    store_dir = os.path.join(backup_path, chunk_store.STORE_DIR)
+    if doomed and os.path.isdir(store_dir):
+        chunk_store.collect_garbage(store_dir, remaining)
 
-def init(backup_path: str):
+
+def set_rate_limit(rate_limit_mb: float) -> None:
+    # For all backup paths together. Call before init
+    global _bucket
+    _bucket = TokenBucket(rate_limit_mb * MB) if rate_limit_mb > 0 else None
+
+
+def init(backup_path: str, fadvise: bool = False, reflink: bool = True,
+         retention: Optional[RetentionPolicy] = None, copy_threads: int = 4, name: str = ''):
     if not os.path.isdir(backup_path):
         os.mkdir(backup_path)
-    
-    try:
-        global _registry
-        with open(os.path.join(backup_path, METADATA_FILE), 'r') as input:
-            _registry = json.loads(input.read())
-    except Exception:
-        _registry = DEFAULT_REGISTRY
+
+    # Clones share blocks with the live file until the server writes to it, so a capture is
+    # close to free and unchanged data takes no extra space
+    reflink = reflink and supports_reflink(backup_path)
+    logger.info(f'Reflink copies {"enabled" if reflink else "not supported"} in {backup_path}')
+    _engines[backup_path] = CopyEngine(fadvise=fadvise, reflink=reflink, bucket=_bucket)
+    _copy_threads[backup_path] = copy_threads
+    _names[backup_path] = name
+    _policies[backup_path] = retention or DEFAULT_RETENTION
+
+    # Opening the registry migrates an old backups.json
+    get_registry(backup_path)
@@ -0,0 +1,154 @@
+from typing import TypedDict, Optional, Callable, Tuple
+import os
+import ctypes
+import platform
+import datetime
+import threading
+import queue
+import logging
+
+import backup
+
+
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALL = {
+    'x86_64': 251,
+    'aarch64': 30,
+    'i386': 289,
+    'i686': 289
+}
+
+# (nice, io class, io level)
+Priority = Tuple[int, int, int]
+
+
+def apply_priority(priority: Priority) -> None:
+    # Applies to the calling thread only. Linux keeps both values per thread
+    nice, io_class, io_level = priority
+    logger = logging.getLogger(__name__)
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, nice)
+    except (OSError, AttributeError) as e:
+        logger.debug(f'Could not set backup nice value: {e}')
+    syscall = IOPRIO_SET_SYSCALL.get(platform.machine())
+    if syscall is None:
+        return
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        ioprio = (io_class << IOPRIO_CLASS_SHIFT) | io_level
+        if libc.syscall(syscall, IOPRIO_WHO_PROCESS, tid, ioprio) < 0:
+            logger.debug(f'Could not set backup io priority: errno {ctypes.get_errno()}')
+    except OSError as e:
+        logger.debug(f'Could not set backup io priority: {e}')
+
+
+class BackupStatus(TypedDict):
+    state: str  # idle, running
+    pending: int
+    completed: int
+    failed: int
+    last_started: Optional[float]
+    last_finished: Optional[float]
+    last_duration: Optional[float]
+    last_error: Optional[str]
+
+
+class BackupWorker:
+    def __init__(self, on_complete: Optional[Callable[[BackupStatus], None]] = None,
+                 priority: Optional[Callable[[], Priority]] = None) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.on_complete = on_complete
+        self.priority = priority
+        self._queue: 'queue.Queue[Optional[backup.Snapshot]]' = queue.Queue()
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._status: BackupStatus = {
+            'state': 'idle',
+            'pending': 0,
+            'completed': 0,
+            'failed': 0,
+            'last_started': None,
+            'last_finished': None,
+            'last_duration': None,
+            'last_error': None
+        }
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                break
+
+            start = datetime.datetime.now().timestamp()
+            with self._lock:
+                self._status['state'] = 'running'
+                self._status['last_started'] = start
+            error = self._finalize(snapshot)
+
+            end = datetime.datetime.now().timestamp()
+            with self._lock:
+                self._status['pending'] -= 1
+                self._status['state'] = 'running' if self._status['pending'] else 'idle'
+                self._status['last_finished'] = end
+                self._status['last_duration'] = end - start
+                self._status['last_error'] = error
+                if error:
+                    self._status['failed'] += 1
+                else:
+                    self._status['completed'] += 1
+                status = self.status()
+                self._idle.notify_all()
+
+            if self.on_complete:
+                try:
+                    self.on_complete(status)
+                except Exception:
+                    self.logger.exception('Backup completion callback failed')
+
+    def _finalize(self, snapshot: backup.Snapshot) -> Optional[str]:
+        # Runs on a fresh thread each time: an unprivileged thread can lower its own priority
+        # but never raise it again, and the new thread starts from this thread's priority
+        priority = self.priority() if self.priority else None
+        error: Optional[str] = None
+
+        def run() -> None:
+            nonlocal error
+            if priority:
+                self.logger.info(f'Finishing backup with nice {priority[0]}, io class {priority[1]}')
+                apply_priority(priority)
+            try:
+                backup.finalize(snapshot)
+            except Exception as e:
+                self.logger.exception(f'Failed to finish backup {snapshot["backup_dir"]}')
+                error = str(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        return error
+
+    def submit(self, snapshot: backup.Snapshot) -> None:
+        with self._lock:
+            self._status['pending'] += 1
+        self._queue.put(snapshot)
+
+    def status(self) -> BackupStatus:
+        with self._lock:
+            return dict(self._status)
+
+    def busy(self) -> bool:
+        return self.status()['pending'] > 0
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        with self._lock:
+            return self._idle.wait_for(lambda: self._status['pending'] == 0, timeout)
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
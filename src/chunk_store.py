@@ -0,0 +1,240 @@
+from typing import TypedDict, List, Optional, Dict, Tuple, Set
+import os
+import json
+import struct
+import hashlib
+import logging
+
+STORE_DIR = 'chunks'
+MANIFEST_FILE = 'manifest.json'
+SECTOR_SIZE = 4096
+HEADER_SIZE = 2 * SECTOR_SIZE
+REGION_CHUNKS = 1024
+
+logger = logging.getLogger(__name__)
+
+
+class FileEntry(TypedDict):
+    path: str  # local to the save dir
+    size: int
+    mtime: int  # ns
+    blob: Optional[str]  # Set for plain files and regions that could not be parsed
+    header: Optional[str]  # Timestamp table of a region file
+    chunks: List[Tuple[int, str]]  # (index in region, blob)
+
+
+class Manifest(TypedDict):
+    files: List[FileEntry]
+
+
+def _blob_path(store_dir: str, key: str) -> str:
+    return os.path.join(store_dir, key[:2], key)
+
+
+def _put_blob(store_dir: str, data: bytes) -> Tuple[str, int]:
+    key = hashlib.sha256(data).hexdigest()
+    path = _blob_path(store_dir, key)
+    if os.path.isfile(path):
+        return key, 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(data)
+    os.replace(tmp, path)
+    return key, len(data)
+
+
+def read_blob(store_dir: str, key: str) -> bytes:
+    with open(_blob_path(store_dir, key), 'rb') as blob:
+        return blob.read()
+
+
+def split_region(data: bytes) -> Optional[Tuple[bytes, List[Tuple[int, bytes]]]]:
+    if len(data) < HEADER_SIZE:
+        return None
+    chunks: List[Tuple[int, bytes]] = []
+    for i in range(REGION_CHUNKS):
+        entry = struct.unpack_from('>I', data, i * 4)[0]
+        offset = (entry >> 8) * SECTOR_SIZE
+        sectors = entry & 0xFF
+        if offset == 0 and sectors == 0:
+            continue
+        if offset < HEADER_SIZE or offset + 5 > len(data):
+            return None
+        length = struct.unpack_from('>I', data, offset)[0]
+        end = offset + 4 + length
+        if length == 0 or end > len(data) or length + 4 > sectors * SECTOR_SIZE:
+            return None
+        chunks.append((i, data[offset:end]))
+    return data[SECTOR_SIZE:HEADER_SIZE], chunks
+
+
+def join_region(timestamps: bytes, chunks: List[Tuple[int, bytes]]) -> bytes:
+    offsets = bytearray(SECTOR_SIZE)
+    body = bytearray()
+    sector = HEADER_SIZE // SECTOR_SIZE
+    for index, chunk in chunks:
+        count = (len(chunk) + SECTOR_SIZE - 1) // SECTOR_SIZE
+        struct.pack_into('>I', offsets, index * 4, (sector << 8) | min(count, 0xFF))
+        body += chunk
+        body += bytes(count * SECTOR_SIZE - len(chunk))
+        sector += count
+    return bytes(offsets) + timestamps + bytes(body)
+
+
+def load_manifest(snapshot_dir: str) -> Optional[Manifest]:
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST_FILE), 'r') as input:
+            return json.loads(input.read())
+    except Exception:
+        return None
+
+
+def _write_manifest(snapshot_dir: str, manifest: Manifest) -> None:
+    path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as out:
+        out.write(json.dumps(manifest))
+    os.replace(tmp, path)
+
+
+def _store_file(store_dir: str, src: str, rel: str) -> Tuple[FileEntry, int]:
+    st = os.stat(src)
+    with open(src, 'rb') as input:
+        data = input.read()
+    entry: FileEntry = {
+        'path': rel,
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'blob': None,
+        'header': None,
+        'chunks': []
+    }
+    written = 0
+    region = split_region(data) if rel.endswith('.mca') else None
+    if region:
+        timestamps, chunks = region
+        entry['header'], n = _put_blob(store_dir, timestamps)
+        written += n
+        for index, chunk in chunks:
+            key, n = _put_blob(store_dir, chunk)
+            entry['chunks'].append((index, key))
+            written += n
+    else:
+        entry['blob'], written = _put_blob(store_dir, data)
+    return entry, written
+
+
+def write_snapshot(save_path: str, snapshot_dir: str, store_dir: str,
+                   previous: Optional[Manifest] = None) -> int:
+    known: Dict[str, FileEntry] = {}
+    if previous:
+        known = {f['path']: f for f in previous['files']}
+
+    manifest: Manifest = {'files': []}
+    written = 0
+    for root, _, files in os.walk(save_path):
+        for name in files:
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, save_path)
+            prev = known.get(rel)
+            st = os.stat(src)
+            if prev and prev['size'] == st.st_size and prev['mtime'] == st.st_mtime_ns:
+                manifest['files'].append(prev)
+                continue
+            entry, n = _store_file(store_dir, src, rel)
+            manifest['files'].append(entry)
+            written += n
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    _write_manifest(snapshot_dir, manifest)
+    return written
+
+
+def _get_verified_blob(store_dir: str, key: str) -> bytes:
+    data = read_blob(store_dir, key)
+    if hashlib.sha256(data).hexdigest() != key:
+        raise Exception(f'Chunk store blob {key} is corrupt')
+    return data
+
+
+def read_file(store_dir: str, entry: FileEntry) -> bytes:
+    if entry['blob']:
+        return _get_verified_blob(store_dir, entry['blob'])
+    return join_region(
+        _get_verified_blob(store_dir, entry['header']),
+        [(index, _get_verified_blob(store_dir, key)) for index, key in entry['chunks']]
+    )
+
+
+def read_chunks(store_dir: str, entry: FileEntry, indices: Set[int]) -> bytes:
+    # A region holding only the wanted chunks, so only their blobs are read
+    return join_region(
+        _get_verified_blob(store_dir, entry['header']),
+        [(index, _get_verified_blob(store_dir, key)) for index, key in entry['chunks'] if index in indices]
+    )
+
+
+def restore_file(store_dir: str, entry: FileEntry, dst: str) -> None:
+    data = read_file(store_dir, entry)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(dst, 'wb') as out:
+        out.write(data)
+    os.utime(dst, ns=(entry['mtime'], entry['mtime']))
+
+
+def restore_snapshot(snapshot_dir: str, store_dir: str, dst_dir: str) -> None:
+    manifest = load_manifest(snapshot_dir)
+    if manifest is None:
+        raise Exception(f'No chunk manifest in {snapshot_dir}')
+    for entry in manifest['files']:
+        restore_file(store_dir, entry, os.path.join(dst_dir, entry['path']))
+
+
+def _referenced(manifest: Manifest) -> Set[str]:
+    keys: Set[str] = set()
+    for entry in manifest['files']:
+        if entry['blob']:
+            keys.add(entry['blob'])
+        else:
+            keys.add(entry['header'])
+            keys.update(key for _, key in entry['chunks'])
+    return keys
+
+
+def blob_usage(snapshot_dir: str, store_dir: str, sizes: Dict[str, int]) -> Dict[str, int]:
+    # Disk space of each blob the snapshot references. sizes caches blobs already looked up,
+    # since most of them are shared by many snapshots
+    manifest = load_manifest(snapshot_dir)
+    if not manifest:
+        return {}
+    usage: Dict[str, int] = {}
+    for key in _referenced(manifest):
+        if key not in sizes:
+            try:
+                sizes[key] = os.stat(_blob_path(store_dir, key)).st_blocks * 512
+            except FileNotFoundError:
+                sizes[key] = 0
+        usage[key] = sizes[key]
+    return usage
+
+
+def collect_garbage(store_dir: str, snapshot_dirs: List[str]) -> int:
+    if not os.path.isdir(store_dir):
+        return 0
+    live: Set[str] = set()
+    for snapshot_dir in snapshot_dirs:
+        manifest = load_manifest(snapshot_dir)
+        if manifest:
+            live |= _referenced(manifest)
+
+    freed = 0
+    for prefix in os.listdir(store_dir):
+        bucket = os.path.join(store_dir, prefix)
+        for key in os.listdir(bucket):
+            if key not in live:
+                path = os.path.join(bucket, key)
+                freed += os.path.getsize(path)
+                os.remove(path)
+    logger.info(f'Freed {freed} bytes of unreferenced chunks')
+    return freed
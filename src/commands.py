@@ -0,0 +1,123 @@
+from typing import Optional, List, Tuple, Union, Pattern, Callable
+from concurrent.futures import Future
+import re
+import threading
+import logging
+
+from log_follower import LineSource
+
+Matcher = Union[str, Pattern, None]
+
+
+class TooManyLines(Exception):
+    pass
+
+
+def compile_matcher(success: Matcher) -> Optional[Pattern]:
+    if not success:
+        return None
+    if isinstance(success, str):
+        return re.compile(re.escape(success))
+    return success
+
+
+class PendingCommand:
+    def __init__(self, command: Optional[str], matcher: Pattern, return_next_line: bool) -> None:
+        self.command = command
+        self.matcher = matcher
+        self.return_next_line = return_next_line
+        self.future: 'Future[str]' = Future()
+        self.found = False
+        self.lines = 0
+
+    def describe(self) -> str:
+        return self.command or self.matcher.pattern
+
+
+class CommandDispatcher:
+    def __init__(self, write: Callable[[str], None], source: LineSource, max_lines: int) -> None:
+        self.logger = logging.getLogger(__name__)
+        self._write = write
+        self._source = source
+        self._max_lines = max_lines
+        self._pending: List[PendingCommand] = []
+        self._lock = threading.Lock()
+        source.subscribe(self._on_line)
+
+    def close(self) -> None:
+        self._source.unsubscribe(self._on_line)
+        self.fail_all(Exception('Command dispatcher closed'))
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def expect(self, success: Matcher, return_next_line: bool = False) -> PendingCommand:
+        pending = PendingCommand(None, compile_matcher(success), return_next_line)
+        with self._lock:
+            self._pending.append(pending)
+        return pending
+
+    def submit_batch(self, commands: List[Tuple[str, Matcher, bool]]) -> List[Optional[PendingCommand]]:
+        # Commands are registered and written under one lock so responses line up with the write order
+        result: List[Optional[PendingCommand]] = []
+        with self._lock:
+            for command, success, return_next_line in commands:
+                matcher = compile_matcher(success)
+                if matcher:
+                    pending = PendingCommand(command, matcher, return_next_line)
+                    self._pending.append(pending)
+                    result.append(pending)
+                else:
+                    result.append(None)
+            self._write(''.join(f'{command}\n' for command, _, _ in commands))
+        return result
+
+    def submit(self, command: str, success: Matcher, return_next_line: bool = False) -> Optional[PendingCommand]:
+        return self.submit_batch([(command, success, return_next_line)])[0]
+
+    def cancel(self, pending: PendingCommand) -> None:
+        with self._lock:
+            if pending in self._pending:
+                self._pending.remove(pending)
+        pending.future.cancel()
+
+    def fail_all(self, error: Exception) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for p in pending:
+            if not p.future.done():
+                p.future.set_exception(error)
+
+    def _on_line(self, line: str) -> None:
+        done: List[Tuple[PendingCommand, Union[str, Exception]]] = []
+        with self._lock:
+            consumed = False
+            for pending in self._pending:
+                pending.lines += 1
+                if consumed:
+                    continue
+                if pending.found:
+                    done.append((pending, line))
+                    consumed = True
+                elif pending.matcher.search(line):
+                    if pending.return_next_line:
+                        pending.found = True
+                    else:
+                        done.append((pending, line))
+                    consumed = True
+            for pending in self._pending:
+                if pending.lines >= self._max_lines and pending not in [d[0] for d in done]:
+                    done.append((pending, TooManyLines(
+                        f'Exceeded {self._max_lines} logs before finding desired output: "{pending.describe()}"'
+                    )))
+            finished = [d[0] for d in done]
+            self._pending = [p for p in self._pending if p not in finished]
+
+        for pending, result in done:
+            if pending.future.done():
+                continue
+            if isinstance(result, Exception):
+                pending.future.set_exception(result)
+            else:
+                pending.future.set_result(result)
@@ -0,0 +1,47 @@
+from typing import Optional, TextIO
+import queue
+import threading
+import logging
+from logging.handlers import QueueListener, TimedRotatingFileHandler
+
+from log_follower import LineSource
+
+
+class ConsoleReader(LineSource):
+    def __init__(self, stream: TextIO, log_path: Optional[str] = None) -> None:
+        super().__init__()
+        self.stream = stream
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._listener: Optional[QueueListener] = None
+        self._log_queue: 'queue.SimpleQueue[logging.LogRecord]' = queue.SimpleQueue()
+        if log_path:
+            handler = TimedRotatingFileHandler(log_path, when='midnight', interval=1, backupCount=7)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._listener = QueueListener(self._log_queue, handler)
+
+    def start(self) -> None:
+        if self._listener:
+            self._listener.start()
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._listener:
+            self._listener.stop()
+
+    def _run(self) -> None:
+        # Ends by itself when the server exits and closes its end of the pipe. The pipe has to
+        # keep being drained or the server blocks writing to its console
+        try:
+            for line in self.stream:
+                try:
+                    if not line.endswith('\n'):
+                        line += '\n'
+                    if self._listener:
+                        self._log_queue.put(logging.makeLogRecord({'msg': line.rstrip('\n')}))
+                    self._publish(line)
+                except Exception:
+                    self.logger.exception('Failed to handle console line')
+        except Exception:
+            self.logger.exception('Console reader failed')
@@ -0,0 +1,111 @@
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+import os
+import json
+import socket
+import asyncio
+import threading
+import logging
+
+Request = Dict[str, Any]
+Response = Dict[str, Any]
+# Handlers run on a worker thread. Returning an iterator streams one JSON line per item
+Handler = Callable[[Request], Union[Response, Iterator[Response]]]
+
+MAX_REQUEST = 64 * 1024
+
+
+def parse_request(line: str) -> Request:
+    line = line.strip()
+    if line.startswith('{'):
+        return json.loads(line)
+    # Plain text requests like "stop" are still accepted for quick use from a shell
+    cmd, _, args = line.partition(' ')
+    return {'cmd': cmd, 'args': args}
+
+
+def send_control(path: str, request: Request, timeout: float = 30) -> Iterator[Response]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as replies:
+            for line in replies:
+                yield json.loads(line)
+
+
+class ControlServer:
+    def __init__(self, path: str) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self._handlers: Dict[str, Handler] = {}
+        self._loop = asyncio.new_event_loop()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def register(self, name: str, handler: Handler) -> None:
+        self._handlers[name] = handler
+
+    def start(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._serve(), self._loop).result(5)
+        self.logger.info(f'Listening for control commands on {self.path}')
+
+    def stop(self) -> None:
+        if not self._thread.is_alive():
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        if self._server:
+            self._server.close()
+        self._loop.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _serve(self) -> None:
+        self._server = await asyncio.start_unix_server(self._on_client, path=self.path, limit=MAX_REQUEST)
+
+    async def _write(self, writer: asyncio.StreamWriter, response: Response) -> None:
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+        await writer.drain()
+
+    async def _on_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line = await reader.readline()
+            if line:
+                await self._handle(line.decode('utf-8', errors='replace'), writer)
+        except Exception as e:
+            self.logger.exception('Control request failed')
+            try:
+                await self._write(writer, {'ok': False, 'error': str(e)})
+            except Exception:
+                pass
+        finally:
+            writer.close()
+
+    async def _handle(self, line: str, writer: asyncio.StreamWriter) -> None:
+        request = parse_request(line)
+        name = request.get('cmd', '')
+        handler = self._handlers.get(name)
+        if not handler:
+            await self._write(writer, {'ok': False, 'error': f'unknown command: {name}'})
+            return
+
+        result = await self._loop.run_in_executor(None, handler, request)
+        if isinstance(result, dict):
+            await self._write(writer, result)
+            return
+
+        done = object()
+        while True:
+            item = await self._loop.run_in_executor(None, next, result, done)
+            if item is done:
+                break
+            await self._write(writer, item)
+        await self._write(writer, {'ok': True, 'done': True})
@@ -0,0 +1,163 @@
+from typing import Optional, Any, Tuple
+import os
+import time
+import fcntl
+import errno
+import ctypes
+import ctypes.util
+import shutil
+import tempfile
+import threading
+import logging
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MB = 1024 * 1024
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+# Errors that mean the pair of files can not be cloned, as opposed to a real I/O failure
+NO_CLONE_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EBADF)
+SYNC_FILE_RANGE_WRITE = 2
+
+
+def _load_sync_file_range() -> Optional[Any]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sync_file_range = libc.sync_file_range
+    except (OSError, AttributeError):
+        return None
+    sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    return sync_file_range
+
+
+_sync_file_range = _load_sync_file_range()
+
+
+def supports_reflink(directory: str) -> bool:
+    try:
+        with tempfile.NamedTemporaryFile(dir=directory) as src, \
+                tempfile.NamedTemporaryFile(dir=directory) as dst:
+            src.write(b'reflink')
+            src.flush()
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+    except OSError:
+        return False
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or max(rate, CHUNK_SIZE)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                wait = (amount - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class CopyEngine:
+    def __init__(self, rate_limit_mb: float = 0, fadvise: bool = False, reflink: bool = False,
+                 bucket: Optional[TokenBucket] = None) -> None:
+        # A bucket passed in is shared with other engines, rate_limit_mb is ignored then
+        self.logger = logging.getLogger(__name__)
+        self.reflink = reflink
+        self.bucket = bucket or (TokenBucket(rate_limit_mb * MB) if rate_limit_mb > 0 else None)
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self._zero_copy = hasattr(os, 'copy_file_range')
+        self._sendfile = hasattr(os, 'sendfile')
+
+    def _transfer(self, src_fd: int, dst_fd: int, count: int) -> int:
+        if self._zero_copy:
+            try:
+                return os.copy_file_range(src_fd, dst_fd, count)
+            except OSError:
+                # e.g. EXDEV on old kernels or filesystems without support
+                self._zero_copy = False
+        if self._sendfile:
+            try:
+                return os.sendfile(dst_fd, src_fd, None, count)
+            except OSError:
+                self._sendfile = False
+        data = memoryview(os.read(src_fd, count))
+        written = 0
+        while written < len(data):
+            written += os.write(dst_fd, data[written:])
+        return written
+
+    def _clone(self, src_fd: int, dst_fd: int) -> bool:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return True
+        except OSError as e:
+            if e.errno not in NO_CLONE_ERRORS:
+                raise
+            # Most likely the world is on another filesystem than the backups
+            self.logger.info(f'Reflink copies unavailable ({os.strerror(e.errno)}), copying instead')
+            self.reflink = False
+            return False
+
+    def _transfer_hashed(self, src_fd: int, dst_fd: int, count: int, digest: Any) -> int:
+        # Data has to pass through user space to be hashed, so it is read once and fed to
+        # both the hash and the destination
+        data = memoryview(os.read(src_fd, count))
+        digest.update(data)
+        written = 0
+        while written < len(data):
+            written += os.write(dst_fd, data[written:])
+        return written
+
+    def copy_file(self, src: str, dst: str, digest: Optional[Any] = None) -> Tuple[int, bool]:
+        # Returns the bytes copied and whether digest, a hashlib object, was updated with the
+        # contents. That only happens when the data passes through user space anyway, clones
+        # and zero copy transfers are left for the caller to hash later
+        copied = 0
+        with open(src, 'rb') as input, open(dst, 'wb') as out:
+            src_fd = input.fileno()
+            dst_fd = out.fileno()
+            size = os.fstat(src_fd).st_size
+            if self.reflink and self._clone(src_fd, dst_fd):
+                shutil.copystat(src, dst)
+                return size, False
+            if self.fadvise:
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            hashed = digest is not None and not self._zero_copy and not self._sendfile
+            while True:
+                count = min(CHUNK_SIZE, max(size - copied, 1))
+                if self.bucket:
+                    self.bucket.consume(count)
+                if hashed:
+                    n = self._transfer_hashed(src_fd, dst_fd, count, digest)
+                else:
+                    n = self._transfer(src_fd, dst_fd, count)
+                if n <= 0:
+                    break
+                copied += n
+            if self.fadvise and _sync_file_range:
+                # Only starts writeback, waiting for it would keep saving off for longer. The
+                # pages are dropped by drop_cache once the backup is finished
+                _sync_file_range(dst_fd, 0, 0, SYNC_FILE_RANGE_WRITE)
+        shutil.copystat(src, dst)
+        return copied, hashed
+
+    def drop_cache(self, path: str) -> None:
+        # Written pages can only be dropped once they are on disk. Pages of the source are left
+        # alone since the running server is likely using them
+        if not self.fadvise:
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
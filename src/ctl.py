@@ -0,0 +1,40 @@
+import json
+import sys
+
+from server_config import control_socket
+from control import send_control
+
+USAGE = 'Usage: ctl.py [--instance <name>] status | backup | reload | command <console command>'
+
+
+def main():
+    args = sys.argv[1:]
+    name = ''
+    if args[:1] == ['--instance'] and len(args) > 1:
+        name, args = args[1], args[2:]
+    if not args:
+        print(USAGE)
+        sys.exit(1)
+
+    request = {'cmd': args[0]}
+    if args[0] == 'command':
+        request['command'] = ' '.join(args[1:])
+
+    try:
+        ok = True
+        # Backups can take a while when the previous one is still finishing
+        for reply in send_control(control_socket(name), request, timeout=600):
+            ok = ok and reply.get('ok', False)
+            if 'line' in reply:
+                print(reply['line'])
+            elif not reply.get('done'):
+                print(json.dumps(reply, indent=4))
+    except OSError as e:
+        print(f'Failed to reach the manager, is it running? {e}')
+        sys.exit(1)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,27 @@
-import datetime
 import logging
 
 from server import Server
 from eggs.egg import Egg
 from server_config import Config
 
+LAG_RETRY = 60
+
 
 class AutosaveEgg(Egg):
     def __init__(self, config: Config) -> None:
-        super().__init__('Autosave', False)
-        self._last_time = datetime.datetime.now().timestamp()
-        self._interval = config['backup_interval']
+        super().__init__('Autosave', False, config['backup_interval'])
+        self._max_defer = config['tps_max_backup_defer']
+        self._deferred = 0.0
         self.logger = logging.getLogger(__name__)
 
-    def _do_update(self, server: Server) -> None:
-        if datetime.datetime.now().timestamp() - self._last_time >= self._interval:
-            self._last_time = datetime.datetime.now().timestamp()
-            self.logger.info('Saving game')
-            server.save_game()
-            self.logger.info('Save complete')
+    def _do_update(self, server: Server) -> bool:
+        if server.ticks.is_lagging() and self._deferred < self._max_defer:
+            self.logger.info(f'Server is lagging ({server.ticks.mean_mspt():.1f} mspt), delaying backup')
+            self._deferred += LAG_RETRY
+            return self.defer(LAG_RETRY)
+        self._deferred = 0.0
+
+        self.logger.info('Saving game')
+        server.save_game()
+        self.logger.info('Save complete')
+        return True
@@ -1,4 +1,3 @@
-import datetime
 import random
 
 from server import Server
@@ -8,12 +7,10 @@ from server_config import Config
 
 class CreeperEgg(Egg):
     def __init__(self, config: Config) -> None:
-        super().__init__('CreeperSound', False)
-        self._last_time = datetime.datetime.now().timestamp()
-        self._interval = config['creeper_interval']
+        super().__init__('CreeperSound', False, config['creeper_interval'])
 
-    def _do_update(self, server: Server) -> None:
-        if datetime.datetime.now().timestamp() - self._last_time >= self._interval:
-            if random.randrange(0, 100) <= 20:
-                self._last_time = datetime.datetime.now().timestamp()
-                server.send_command('execute @a ~ ~ ~-3 /playsound entity.creeper.primed hostile @s ~ ~ ~-3 1 0.5', '')
+    def _do_update(self, server: Server) -> bool:
+        if random.randrange(0, 100) <= 20:
+            server.send_command('execute @a ~ ~ ~-3 /playsound entity.creeper.primed hostile @s ~ ~ ~-3 1 0.5', '')
+            return True
+        return False
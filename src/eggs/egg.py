@@ -1,24 +1,46 @@
+from typing import Optional
 import logging
 
 from server import Server
+import metrics
+
+# How long to wait before trying again when an egg decides not to run
+RETRY_INTERVAL = 4 * 60
+
+_egg_seconds = metrics.histogram('egg_update_seconds', 'Time spent running an egg')
+_egg_failures = metrics.counter('egg_failures_total', 'Eggs that raised while running')
 
 
 class Egg:
-    def __init__(self, name: str, is_critical: bool) -> None:
+    def __init__(self, name: str, is_critical: bool, interval: float) -> None:
         self.name = name
         self.is_critical = is_critical
+        self.interval = interval
+        self._defer: Optional[float] = None
         self.logger = logging.getLogger(__name__)
 
-    def update(self, server: Server) -> None:
+    def defer(self, secs: float) -> bool:
+        # For _do_update to run again sooner than the normal retry, returns False to pass along
+        self._defer = secs
+        return False
+
+    def update(self, server: Server) -> float:
+        self._defer = None
         try:
-            self._do_update(server)
+            with _egg_seconds.time(egg=self.name):
+                fired = self._do_update(server)
+            if fired:
+                return self.interval
+            return self._defer if self._defer is not None else RETRY_INTERVAL
         except Exception:
+            _egg_failures.inc(egg=self.name)
             self.logger.exception(f'Egg "{self.name}" failed')
             if not server.server_alive() or self.is_critical:
                 raise
             else:
                 server.send_command('save-all', '')
                 server.send_command('save-on', '')
+            return RETRY_INTERVAL
 
-    def _do_update(self, server: Server) -> None:
+    def _do_update(self, server: Server) -> bool:
         raise NotImplementedError('_do_update must be implemented')
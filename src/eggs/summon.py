@@ -1,38 +1,38 @@
-import datetime
 import logging
 import random
-import time
 
 from server import Server
 from eggs.egg import Egg
 from server_config import Config
 
+LAG_RETRY = 5 * 60
+
 
 class SummonEgg(Egg):
     def __init__(self, config: Config) -> None:
-        super().__init__('Summoner', False)
-        self._last_time = datetime.datetime.now().timestamp()
-        self._interval = config['summon_interval']
+        super().__init__('Summoner', False, config['summon_interval'])
         self._creatures = config['summon_options']
         self.logger = logging.getLogger(__name__)
 
-    def _do_update(self, server: Server) -> None:
-        if datetime.datetime.now().timestamp() - self._last_time >= self._interval:
-            if self._creatures and random.randrange(0, 100) <= 40:
-                self._last_time = datetime.datetime.now().timestamp()
-                
-                players = server.get_players()
-                if players:
-                    item = random.choices(
-                        population=self._creatures,
-                        weights=[item['weight']
-                                for item in self._creatures],
-                        k=1
-                    )[0]
-                    name = item['name']
-                    qty = random.randrange(item['min_qty'], item['max_qty'] + 1)
-                    player = random.choice(players)
-                    server.send_command(f'say {player} better watch out...', '')
-                    time.sleep(5)
-                    for i in range(qty):
-                        server.send_command(f'execute {player} ~ ~ ~ /summon {name}', '')
+    def _do_update(self, server: Server) -> bool:
+        if not self._creatures or random.randrange(0, 100) > 40:
+            return False
+        if server.ticks.is_lagging():
+            # Spawning a horde would only make it worse
+            return self.defer(LAG_RETRY)
+
+        players = server.get_players()
+        if players:
+            item = random.choices(
+                population=self._creatures,
+                weights=[item['weight']
+                        for item in self._creatures],
+                k=1
+            )[0]
+            name = item['name']
+            qty = random.randrange(item['min_qty'], item['max_qty'] + 1)
+            player = random.choice(players)
+            server.send_command(f'say {player} better watch out...', '')
+            server.sleep(5)
+            server.send_commands([f'execute {player} ~ ~ ~ /summon {name}'] * qty)
+        return True
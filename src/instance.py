@@ -0,0 +1,251 @@
+from typing import List, Dict, Any, Optional
+import subprocess
+import threading
+import logging
+import os
+import time
+
+from server_config import load_instance, restore_lock, Config
+import backup
+import metrics
+from server import Server
+from scheduler import Scheduler
+from log_follower import LogFollower, LineSource, file_identity
+from console_reader import ConsoleReader
+from presence import PresenceTracker
+from supervisor import Supervisor
+from readiness import Readiness, StartupFailed
+from restore import wait_for_restore
+import verifier
+
+from eggs.egg import Egg
+from eggs.autosave import AutosaveEgg
+from eggs.item import ItemEgg
+from eggs.talk import TalkEgg
+from eggs.summon import SummonEgg
+from eggs.effect import EffectEgg
+from eggs.creeper import CreeperEgg
+
+LATEST_LOG = os.path.join('logs', 'latest.log')
+MANAGER_LOGS = 'manager_logs'
+
+_ready_seconds = metrics.histogram(
+    'server_time_to_ready_seconds', 'Time from launching the server to it accepting players',
+    (5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+)
+
+
+class Instance:
+    # One server with its own scheduler, backups and control socket. Several can run in one
+    # manager, each on its own thread
+    def __init__(self, config: Config, index: int = 0, count: int = 1) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.name = config['name']
+        self.restore_lock = restore_lock(self.name)
+        # Spreads the first backup of each server over one interval, together with the
+        # snapshot lock this keeps big worlds from being copied at the same time
+        self.backup_offset = config['backup_interval'] * index / count
+        # Lives across restarts along with the backup registry and metrics
+        self.presence = PresenceTracker()
+        self.supervisor = Supervisor(
+            self.run_once,
+            config['restart_delay'],
+            config['restart_max_delay'],
+            config['crash_loop_restarts'],
+            config['crash_loop_window'],
+            config['crash_loop_delay'],
+            self.name
+        )
+        self.minecraft: Optional[Server] = None
+        self._thread: Optional[threading.Thread] = None
+
+        os.makedirs(os.path.join(config['server_path'], MANAGER_LOGS), exist_ok=True)
+        backup.init(
+            config['backup_path'],
+            config['backup_fadvise'],
+            config['backup_reflink'],
+            {
+                'last': config['backup_keep_last'],
+                'hourly': config['backup_keep_hourly'],
+                'daily': config['backup_keep_daily'],
+                'weekly': config['backup_keep_weekly'],
+                'monthly': config['backup_keep_monthly'],
+                'max_total_gb': config['backup_max_total_gb']
+            },
+            config['backup_copy_threads'],
+            self.name
+        )
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.config['server_path'], path)
+
+    def start_game(self) -> subprocess.Popen:
+        cmd = ' '.join(self.config['start_command'])
+        self.logger.info(f'Starting server with: "{cmd}"')
+
+        capture_stdout = self.config['log_source'] == 'stdout'
+        process = subprocess.Popen(
+            self.config['start_command'],
+            cwd=self.config['server_path'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+            stderr=subprocess.STDOUT if capture_stdout else subprocess.DEVNULL,
+            text=True,
+            # A stray byte in the console must not stop the reader, same as the log file
+            errors='replace',
+            bufsize=1,
+            universal_newlines=True
+        )
+        return process
+
+    def open_logs(self, process: subprocess.Popen, stale: Optional[os.stat_result]) -> LineSource:
+        if self.config['log_source'] == 'stdout':
+            log_path = self._path(os.path.join(MANAGER_LOGS, 'console.log'))
+            return ConsoleReader(process.stdout, log_path)
+        return LogFollower(self._path(LATEST_LOG), stale=stale)
+
+    def create_eggs(self) -> List[Egg]:
+        return [
+            AutosaveEgg(self.config),
+            ItemEgg(self.config),
+            TalkEgg(self.config),
+            SummonEgg(self.config),
+            EffectEgg(self.config),
+            CreeperEgg(self.config)
+        ]
+
+    def schedule_eggs(self, scheduler: Scheduler, minecraft: Server, first: bool = False) -> List[Egg]:
+        config = self.config
+        all_eggs = self.create_eggs()
+        for egg in all_eggs:
+            delay = egg.interval
+            if first and isinstance(egg, AutosaveEgg):
+                delay += self.backup_offset
+            scheduler.add(egg.name, lambda egg=egg: egg.update(minecraft), delay)
+        if config['tps_interval']:
+            scheduler.add('TickMonitor', lambda: minecraft.ticks.update(config['tps_interval']), 0)
+        if config['watchdog_interval']:
+            interval = config['watchdog_interval']
+            scheduler.add('Watchdog', lambda: minecraft.watchdog.update(interval), interval)
+        if config['backup_verify_mb_per_hour']:
+            scheduler.add('BackupVerifier', lambda: minecraft.verifier.update(verifier.INTERVAL), verifier.INTERVAL)
+        return all_eggs
+
+    def reload_eggs(self, scheduler: Scheduler, minecraft: Server) -> Dict[str, Any]:
+        self.logger.info('Reloading eggs')
+        # Updated in place since the server holds on to the same config
+        self.config.update(load_instance(self.name))
+        scheduler.clear()
+        all_eggs = self.schedule_eggs(scheduler, minecraft)
+        minecraft.wake()
+        return {'ok': True, 'eggs': [egg.name for egg in all_eggs]}
+
+    def _kill_game(self, process: subprocess.Popen) -> None:
+        # A restart would otherwise start a second server on the same world
+        self.logger.error('Setting up the server failed, killing it')
+        process.kill()
+        process.wait()
+
+    def lifetime(self) -> bool:
+        logger = self.logger
+        config = self.config
+        logger.info('Starting Minecraft')
+        # The old log is skipped until the server replaces it
+        stale = file_identity(self._path(LATEST_LOG))
+        launched = time.monotonic()
+        process = self.start_game()
+        try:
+            logs = self.open_logs(process, stale)
+            readiness = Readiness(logs, process, launched, self.name)
+            logs.start()
+        except Exception:
+            self._kill_game(process)
+            raise
+        try:
+            try:
+                # Players from before a crash are gone, but the tracker and its callbacks are kept
+                self.presence.reset()
+                minecraft = Server(config, process, logs, self.presence)
+            except Exception:
+                # Nothing else would stop the game. It has to be gone before logs.stop(), which
+                # waits for the end of its output
+                self._kill_game(process)
+                raise
+            minecraft.readiness = readiness
+            self.minecraft = minecraft
+            if self.supervisor.stopping():
+                minecraft.killed = True
+            try:
+                _ready_seconds.observe(
+                    readiness.wait(config['startup_timeout'], lambda: minecraft.killed), instance=self.name
+                )
+                logger.info('Minecraft started')
+
+                scheduler = Scheduler(config['scheduler_jitter'])
+                self.schedule_eggs(scheduler, minecraft, first=True)
+                minecraft.control.register('reload', lambda _: self.reload_eggs(scheduler, minecraft))
+            except Exception as e:
+                # A server stuck in startup would not answer a stop command. stop() marks the
+                # server killed, so whether it was asked to stop is read first
+                stopping = minecraft.killed
+                process.kill()
+                minecraft.stop()
+                if isinstance(e, StartupFailed) and stopping:
+                    logger.info('Stopped while starting')
+                    return False
+                raise
+
+            try:
+                scheduler.run(minecraft)
+                if minecraft.killed:
+                    logger.info('Got stop command')
+            except Exception:
+                logger.exception('Got exception while running')
+            finally:
+                # Exit gracefully on kill/crash. stop() marks the server killed, so the
+                # restart decision is made first
+                restart = not minecraft.killed
+                logger.info('Stopping')
+                if minecraft.server_alive():
+                    try:
+                        logger.info('Performing final save')
+                        minecraft.send_command('save-all', '')
+                    except:
+                        pass
+                minecraft.stop()
+                logger.info('Server stopped')
+
+                return restart
+        finally:
+            logs.stop()
+
+    def run_once(self) -> bool:
+        # A stop for a restore is followed by a start once it is done, other stops are final
+        while True:
+            wait_for_restore(self.restore_lock)
+            restart = self.lifetime()
+            if restart or self.supervisor.stopping() or not self.minecraft.stopped_for_restore:
+                return restart
+            self.logger.info('Starting again once the restore is done')
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=self.name or 'server')
+        self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            self.supervisor.run()
+        except Exception:
+            self.logger.exception('Manager failed')
+
+    def stop(self) -> None:
+        self.supervisor.stop()
+        minecraft = self.minecraft
+        if minecraft:
+            minecraft.kill()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        # Returns True once the instance thread is done
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
@@ -0,0 +1,195 @@
+from typing import Callable, List, Optional, BinaryIO
+import os
+import time
+import select
+import ctypes
+import ctypes.util
+import threading
+import logging
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+MIN_BACKOFF = 0.01
+MAX_BACKOFF = 1.0
+# How long a log left over from the last run is ignored while waiting for the new one
+STALE_GRACE = 15
+
+LineCallback = Callable[[str], None]
+
+
+class LineSource:
+    def __init__(self) -> None:
+        self.logger = logging.getLogger(__name__)
+        self._subscribers: List[LineCallback] = []
+        self._sub_lock = threading.Lock()
+
+    def subscribe(self, callback: LineCallback) -> None:
+        with self._sub_lock:
+            self._subscribers = self._subscribers + [callback]
+
+    def unsubscribe(self, callback: LineCallback) -> None:
+        with self._sub_lock:
+            self._subscribers = [s for s in self._subscribers if s is not callback]
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def _publish(self, line: str) -> None:
+        for callback in self._subscribers:
+            try:
+                callback(line)
+            except Exception:
+                self.logger.exception('Line subscriber failed')
+
+
+class _Inotify:
+    def __init__(self, directory: str) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f'inotify_add_watch failed for {directory}')
+
+    def wait(self, timeout: float) -> None:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def file_identity(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+class LogFollower(LineSource):
+    def __init__(self, path: str, from_start: bool = True, stale: Optional[os.stat_result] = None) -> None:
+        # stale is the log as it was before the server started. It is skipped until the server
+        # rotates it and creates a new one
+        super().__init__()
+        self.path = path
+        self._from_start = from_start
+        self._stale = stale
+        self._started = time.monotonic()
+        self._file: Optional[BinaryIO] = None
+        self._partial = b''
+        self._stopped = False
+        self._inotify: Optional[_Inotify] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            # On a server's first start the log directory does not exist yet and can not be watched
+            os.makedirs(directory, exist_ok=True)
+            self._inotify = _Inotify(directory)
+        except Exception as e:
+            self.logger.info(f'inotify unavailable, polling {self.path} instead: {e}')
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._inotify:
+            self._inotify.close()
+        if self._file:
+            self._file.close()
+
+    def _is_stale(self, st: os.stat_result) -> bool:
+        stale = self._stale
+        return stale is not None and st.st_ino == stale.st_ino and st.st_size >= stale.st_size
+
+    def _open(self) -> bool:
+        try:
+            self._file = open(self.path, 'rb')
+        except OSError:
+            return False
+        st = os.fstat(self._file.fileno())
+        if self._is_stale(st):
+            if time.monotonic() - self._started < STALE_GRACE:
+                self._file.close()
+                self._file = None
+                return False
+            # Never rotated, so the server appends to the old log
+            self.logger.info(f'{self.path} was not rotated, reading what was appended to it')
+            self._file.seek(self._stale.st_size)
+        elif not self._from_start:
+            self._file.seek(0, os.SEEK_END)
+        self._stale = None
+        # Any file after the first one is a rotated log and is read from its start
+        self._from_start = True
+        self._partial = b''
+        return True
+
+    def _rotated(self) -> bool:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_ino != os.fstat(self._file.fileno()).st_ino
+
+    def _truncated(self) -> bool:
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+        except OSError:
+            return False
+        if size < self._file.tell():
+            self.logger.info(f'{self.path} was truncated')
+            self._file.seek(0)
+            self._partial = b''
+            return True
+        return False
+
+    def _read_available(self) -> bool:
+        if not self._file and not self._open():
+            return False
+        data = self._file.read()
+        if not data and self._truncated():
+            data = self._file.read()
+        if not data and self._rotated():
+            self.logger.info(f'{self.path} was rotated, reopening')
+            self._file.close()
+            self._file = None
+            return self._open()
+        if not data:
+            return False
+
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._publish(line.decode('utf-8', errors='replace').rstrip('\r') + '\n')
+        return True
+
+    def _run(self) -> None:
+        backoff = MIN_BACKOFF
+        while not self._stopped:
+            if self._read_available():
+                backoff = MIN_BACKOFF
+                continue
+            if self._inotify:
+                # The timeout only bounds how long a stop request or a missed event can go unnoticed
+                self._inotify.wait(MAX_BACKOFF)
+            else:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
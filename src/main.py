@@ -1,27 +1,17 @@
 from typing import List
-import subprocess
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import os
-import time
+import signal
 import sys
 
-from server_config import pid_file, load_config, Config
+from server_config import pid_file, load_config, load_instances
+from instance import Instance, MANAGER_LOGS
 import backup
-from server import Server
+import metrics
 
-from eggs.egg import Egg
-from eggs.autosave import AutosaveEgg
-from eggs.item import ItemEgg
-from eggs.talk import TalkEgg
-from eggs.summon import SummonEgg
-from eggs.effect import EffectEgg
-from eggs.creeper import CreeperEgg
 
-config: Config = {}
-
-
-def setup_logging(log_dir, log_filename):
+def setup_logging(log_dir, log_filename, show_thread=False):
     # Create the log directory if it doesn't exist
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
@@ -33,8 +23,10 @@ def setup_logging(log_dir, log_filename):
     )
 
     # Define the log message format with timestamps
-    formatter = logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    # With several servers the thread name tells which one a line is from
+    fmt = "%(asctime)s - %(threadName)s - %(levelname)s - %(message)s" if show_thread else \
+        "%(asctime)s - %(levelname)s - %(message)s"
+    formatter = logging.Formatter(fmt, datefmt="%Y-%m-%d %H:%M:%S")
     handler.setFormatter(formatter)
     handler.setLevel(logging.DEBUG)
 
@@ -47,102 +39,40 @@ def setup_logging(log_dir, log_filename):
     )
 
 
-logger: logging.Logger = None
-
-killed = False
-
-
-def start_game() -> subprocess.Popen:
-    cmd = ' '.join(config['start_command'])
-    logger.info(f'Starting server with: "{cmd}"')
-
-    process = subprocess.Popen(
-        config['start_command'],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-        text=True,
-        bufsize=1,
-        universal_newlines=True
-    )
-    time.sleep(1)
-    if process.poll() is not None:
-        raise Exception('Failed to launch server')
-
-    return process
-
-
 def write_pid():
     with open(pid_file(), 'w') as out:
         out.write(str(os.getpid()))
 
 
-def lifetime() -> bool:
-    logger.info('Starting Minecraft')
-    process = start_game()
-    time.sleep(3)
-    with open('logs/latest.log', 'r') as logs:
-        minecraft = Server(config, process, logs)
-        minecraft.wait_for_output('DedicatedServer]: Done', timeout=180)
-        logger.info('Minecraft started')
-
-        all_eggs: List[Egg] = [
-            AutosaveEgg(config),
-            ItemEgg(config),
-            TalkEgg(config),
-            SummonEgg(config),
-            EffectEgg(config),
-            CreeperEgg(config)
-        ]
-
-        try:
-            while minecraft.should_run():
-                minecraft.sleep(60)
-                if not minecraft.should_run():
-                    logger.info('Got stop command')
-                    break
-
-                for egg in all_eggs:
-                    egg.update(minecraft)
-                    time.sleep(30)
-
-        except Exception:
-            logger.exception('Got exception while running')
-        finally:
-            # Exit gracefully on kill/crash
-            logger.info('Stopping')
-            if minecraft.server_alive():
-                try:
-                    logger.info('Performing final save')
-                    minecraft.send_command('save-all', '')
-                except:
-                    pass
-            minecraft.stop()
-            logger.info('Server stopped')
-
-            return not minecraft.killed
-
-
 def main():
-    global config
-    global logger
-
     config = load_config()
-    os.chdir(config['server_path'])
-    setup_logging(os.path.join(config['server_path'], 'manager_logs'), 'manager.log')
+    configs = load_instances(config)
+    setup_logging(os.path.join(config['server_path'], MANAGER_LOGS), 'manager.log', len(configs) > 1)
     logger = logging.getLogger(__name__)
 
     logger.info('Starting manager')
     write_pid()
-    backup.init(config['backup_path'])
-    logger.info('Manager initialized')
-
-    try:
-        lifetime()
-    except Exception:
-        logger.exception('Manager failed')
-    else:
-        logger.info('Manager exited normally')
+    backup.set_rate_limit(config['backup_rate_limit_mb'])
+    instances: List[Instance] = [Instance(c, i, len(configs)) for i, c in enumerate(configs)]
+    if config['metrics_port']:
+        metrics.serve(config['metrics_port'])
+    if config['metrics_file']:
+        metrics.start_file_writer(os.path.join(config['server_path'], config['metrics_file']), config['metrics_interval'])
+    logger.info(f'Manager initialized with {len(instances)} servers' if len(instances) > 1 else 'Manager initialized')
+
+    def on_signal(_1, _2) -> None:
+        for instance in instances:
+            instance.stop()
+
+    # Signals only reach the main thread, the servers run on their own
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    for instance in instances:
+        instance.start()
+    for instance in instances:
+        while not instance.join(1):
+            pass
+    logger.info('Manager exited normally')
 
 
 if __name__ == '__main__':
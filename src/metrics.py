@@ -0,0 +1,209 @@
+from typing import Dict, List, Tuple, Optional, Iterator
+import os
+import math
+import time
+import threading
+import contextlib
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+logger = logging.getLogger(__name__)
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        raise NotImplementedError('render must be implemented')
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(k)} {_format_value(v)}' for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        counts = self._counts.get(_label_key(labels))
+        return counts[-1] if counts else 0
+
+    def render(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(key, ("le", _format_value(bound)))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(self._sums[key])}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {counts[-1]}')
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls: type, name: str, help: str, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, **kwargs)
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str) -> Counter:
+    return REGISTRY.counter(name, help)
+
+
+def gauge(name: str, help: str) -> Gauge:
+    return REGISTRY.gauge(name, help)
+
+
+def histogram(name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def serve(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
+
+
+def write_file(path: str) -> None:
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as out:
+        out.write(REGISTRY.render())
+    os.replace(tmp, path)
+
+
+def start_file_writer(path: str, interval: float) -> threading.Thread:
+    def run() -> None:
+        while True:
+            try:
+                write_file(path)
+            except Exception:
+                logger.exception(f'Failed to write metrics to {path}')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
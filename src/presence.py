@@ -0,0 +1,88 @@
+from typing import Callable, List, Set, Optional
+import datetime
+import re
+import threading
+import logging
+
+from log_follower import LineSource
+
+# Names are anchored to the logger prefix and the end of the line so chat can not fake them
+JOIN_MSG = re.compile(r'\]: ([A-Za-z0-9_]{1,16}) joined the game\s*$')
+LEAVE_MSG = re.compile(r'\]: ([A-Za-z0-9_]{1,16}) left the game\s*$')
+
+PresenceCallback = Callable[[str], None]
+
+
+class PresenceTracker:
+    def __init__(self) -> None:
+        self.logger = logging.getLogger(__name__)
+        self._players: Set[str] = set()
+        self._lock = threading.Lock()
+        self._on_join: List[PresenceCallback] = []
+        self._on_leave: List[PresenceCallback] = []
+        self._source: Optional[LineSource] = None
+        self.last_sync: Optional[float] = None
+
+    def attach(self, source: LineSource) -> None:
+        self.detach()
+        self._source = source
+        source.subscribe(self._on_line)
+
+    def detach(self) -> None:
+        if self._source:
+            self._source.unsubscribe(self._on_line)
+            self._source = None
+
+    def on_join(self, callback: PresenceCallback) -> None:
+        self._on_join.append(callback)
+
+    def on_leave(self, callback: PresenceCallback) -> None:
+        self._on_leave.append(callback)
+
+    def players(self) -> List[str]:
+        with self._lock:
+            return sorted(self._players)
+
+    def count(self) -> int:
+        return len(self._players)
+
+    def needs_sync(self, max_age: float) -> bool:
+        return self.last_sync is None or datetime.datetime.now().timestamp() - self.last_sync > max_age
+
+    def sync(self, players: List[str]) -> None:
+        with self._lock:
+            joined = set(players) - self._players
+            left = self._players - set(players)
+            self._players = set(players)
+            self.last_sync = datetime.datetime.now().timestamp()
+        if joined or left:
+            self.logger.info(f'Player list was out of date. Missed joins: {joined}, missed leaves: {left}')
+        for player in joined:
+            self._notify(self._on_join, player)
+        for player in left:
+            self._notify(self._on_leave, player)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._players = set()
+            self.last_sync = None
+
+    def _notify(self, callbacks: List[PresenceCallback], player: str) -> None:
+        for callback in callbacks:
+            try:
+                callback(player)
+            except Exception:
+                self.logger.exception(f'Presence callback failed for {player}')
+
+    def _on_line(self, line: str) -> None:
+        match = JOIN_MSG.search(line)
+        if match:
+            with self._lock:
+                self._players.add(match.group(1))
+            self._notify(self._on_join, match.group(1))
+            return
+        match = LEAVE_MSG.search(line)
+        if match:
+            with self._lock:
+                self._players.discard(match.group(1))
+            self._notify(self._on_leave, match.group(1))
@@ -0,0 +1,149 @@
+from typing import Optional, List, Dict, Tuple
+import select
+import socket
+import struct
+import threading
+import logging
+
+TYPE_RESPONSE = 0
+TYPE_COMMAND = 2
+TYPE_LOGIN = 3
+
+MAX_ATTEMPTS = 2
+
+
+class RconError(Exception):
+    pass
+
+
+class _NotSent(Exception):
+    # Nothing reached the server, so the batch is safe to send again on a new connection
+    pass
+
+
+class RconClient:
+    def __init__(self, host: str, port: int, password: str, timeout: float = 30) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            self._disconnect()
+
+    def _disconnect(self) -> None:
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _request_id(self) -> int:
+        request_id = self._next_id
+        self._next_id = self._next_id % 0x7FFFFFFF + 1
+        return request_id
+
+    def _send(self, request_id: int, type: int, body: str) -> None:
+        payload = struct.pack('<ii', request_id, type) + body.encode('utf-8') + b'\x00\x00'
+        self._sock.sendall(struct.pack('<i', len(payload)) + payload)
+
+    def _recv_exact(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            part = self._sock.recv(size - len(data))
+            if not part:
+                raise RconError('Connection closed by server')
+            data += part
+        return data
+
+    def _recv(self) -> Tuple[int, int, str]:
+        length = struct.unpack('<i', self._recv_exact(4))[0]
+        payload = self._recv_exact(length)
+        request_id, type = struct.unpack_from('<ii', payload)
+        return request_id, type, payload[8:-2].decode('utf-8', errors='replace')
+
+    def _connect(self) -> None:
+        self.logger.info(f'Connecting to RCON at {self.host}:{self.port}')
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        request_id = self._request_id()
+        self._send(request_id, TYPE_LOGIN, self.password)
+        while True:
+            response_id, type, _ = self._recv()
+            if response_id == -1:
+                self._disconnect()
+                raise RconError('RCON authentication failed')
+            if response_id == request_id and type == TYPE_COMMAND:
+                return
+
+    def _closed_by_server(self) -> bool:
+        # A server that restarted or dropped the connection leaves the socket readable at EOF,
+        # which is only noticed reliably before anything is sent on it
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            return bool(readable) and not self._sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def _run_batch(self, commands: List[str]) -> List[str]:
+        if self._sock and self._closed_by_server():
+            self.logger.info('RCON connection was closed by the server')
+            self._disconnect()
+
+        ids = []
+        try:
+            if not self._sock:
+                self._connect()
+            request_id = self._request_id()
+            ids.append(request_id)
+            self._send(request_id, TYPE_COMMAND, commands[0])
+        except socket.timeout:
+            raise
+        except OSError as e:
+            raise _NotSent(e)
+        for command in commands[1:]:
+            request_id = self._request_id()
+            ids.append(request_id)
+            self._send(request_id, TYPE_COMMAND, command)
+        # Large responses are split over several packets with no end marker, so an invalid
+        # request is sent after the batch and its echo marks the end of the real responses
+        marker = self._request_id()
+        self._send(marker, TYPE_RESPONSE, '')
+
+        bodies: Dict[int, str] = {request_id: '' for request_id in ids}
+        while True:
+            response_id, _, body = self._recv()
+            if response_id == marker:
+                return [bodies[request_id] for request_id in ids]
+            if response_id in bodies:
+                bodies[response_id] += body
+
+    def commands(self, commands: List[str]) -> List[str]:
+        # Only retried when the connection failed before any command went out. Once one was sent
+        # it may have run, and commands like summon or give must not run twice
+        if not commands:
+            return []
+        with self._lock:
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    return self._run_batch(commands)
+                except _NotSent as e:
+                    self._disconnect()
+                    if attempt + 1 >= MAX_ATTEMPTS:
+                        raise RconError(f'RCON connection failed: {e}')
+                    self.logger.warning(f'RCON connection lost, reconnecting: {e}')
+                except socket.timeout:
+                    self._disconnect()
+                    raise RconError(f'RCON command timed out after {self.timeout}s')
+                except (OSError, RconError) as e:
+                    self._disconnect()
+                    raise RconError(f'RCON command failed: {e}')
+        return []
+
+    def command(self, command: str) -> str:
+        return self.commands([command])[0]
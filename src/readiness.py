@@ -0,0 +1,137 @@
+from typing import TypedDict, List, Optional, Dict, Pattern, Tuple, Callable
+import re
+import time
+import threading
+import subprocess
+import logging
+
+import metrics
+from log_follower import LineSource
+
+# launch runs from starting the process to its first log line. Each phase after it starts at
+# the first line matching its pattern and ends where the next one starts. Phases that never
+# show up, like mods on a vanilla server, are skipped
+PHASES: List[Tuple[str, Pattern]] = [
+    ('bootstrap', re.compile(r'.')),
+    ('server', re.compile(r'\]: Starting minecraft server version')),
+    ('mods', re.compile(r'\]: (Forge Mod Loader version|Searching .* for mods|Loading \d+ mods)')),
+    ('world', re.compile(r'\]: Preparing level')),
+]
+DONE_MSG = re.compile(r'\]: Done \(([\d.]+)s\)!')
+PROGRESS_MSG = re.compile(r'\]: Preparing (?:spawn area|start region for [\w ]+?)[: ]+(\d+)%')
+# Forge reports each loading stage per mod, e.g. "Bar Step: PreInitialization - Galacticraft Core took 2.531s"
+MOD_STEP_MSG = re.compile(r'Bar Step: (\w+) - (.+?) took ([\d.]+)s')
+SLOWEST_MODS = 5
+
+_phase_seconds = metrics.histogram(
+    'server_startup_phase_seconds', 'Time spent in each phase of server startup',
+    (0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180)
+)
+_mod_seconds = metrics.gauge('server_mod_load_seconds', 'Time each mod took to load in the last startup')
+_world_progress = metrics.gauge('server_world_prepare_percent', 'Spawn area preparation progress of the current startup')
+
+
+class Phase(TypedDict):
+    name: str
+    start: float  # Seconds since launch
+    end: Optional[float]
+
+
+class StartupFailed(Exception):
+    pass
+
+
+class Readiness:
+    def __init__(self, source: LineSource, process: subprocess.Popen, launched: float, name: str = '') -> None:
+        # Subscribe before the source starts so no startup line is missed
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.source = source
+        self.process = process
+        self.launched = launched
+        self.phases: List[Phase] = [{'name': 'launch', 'start': 0.0, 'end': None}]
+        self.mods: Dict[str, float] = {}
+        self.reported_seconds: Optional[float] = None
+        self.time_to_ready: Optional[float] = None
+        self._next_phase = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        source.subscribe(self._on_line)
+
+    def _elapsed(self) -> float:
+        return time.monotonic() - self.launched
+
+    def _start_phase(self, name: str, now: float) -> None:
+        self._end_phase(now)
+        self.phases.append({'name': name, 'start': now, 'end': None})
+
+    def _end_phase(self, now: float) -> None:
+        phase = self.phases[-1]
+        if phase['end'] is None:
+            phase['end'] = now
+            _phase_seconds.observe(now - phase['start'], phase=phase['name'], instance=self.name)
+
+    def _on_line(self, line: str) -> None:
+        if self._ready.is_set():
+            return
+        now = self._elapsed()
+        with self._lock:
+            for i in range(self._next_phase, len(PHASES)):
+                name, pattern = PHASES[i]
+                if pattern.search(line):
+                    self._start_phase(name, now)
+                    self._next_phase = i + 1
+                    break
+
+            match = MOD_STEP_MSG.search(line)
+            if match:
+                mod = match.group(2)
+                self.mods[mod] = self.mods.get(mod, 0) + float(match.group(3))
+                return
+            match = PROGRESS_MSG.search(line)
+            if match:
+                _world_progress.set(int(match.group(1)), instance=self.name)
+                return
+            match = DONE_MSG.search(line)
+            if match:
+                self.reported_seconds = float(match.group(1))
+                self.time_to_ready = now
+                self._end_phase(now)
+                _world_progress.set(100, instance=self.name)
+                self._ready.set()
+
+    def wait(self, timeout: float, cancelled: Optional[Callable[[], bool]] = None) -> float:
+        # Returns as soon as the Done line is read, fails early if the server exits or the
+        # manager is stopped first
+        deadline = time.monotonic() + timeout
+        try:
+            while not self._ready.wait(0.25):
+                if cancelled and cancelled():
+                    raise StartupFailed('Stopped while starting')
+                if self.process.poll() is not None:
+                    raise StartupFailed(f'Server exited with code {self.process.returncode} while starting')
+                if time.monotonic() > deadline:
+                    raise StartupFailed(f'Server was not ready after {timeout:.0f}s')
+        finally:
+            self.source.unsubscribe(self._on_line)
+        self._report()
+        return self.time_to_ready
+
+    def _report(self) -> None:
+        timings = ', '.join(f'{p["name"]} {p["end"] - p["start"]:.1f}s' for p in self.phases)
+        self.logger.info(f'Ready after {self.time_to_ready:.1f}s ({timings})')
+        for mod, seconds in self.mods.items():
+            _mod_seconds.set(seconds, mod=mod, instance=self.name)
+        slowest = sorted(self.mods.items(), key=lambda m: m[1], reverse=True)[:SLOWEST_MODS]
+        if slowest:
+            self.logger.info('Slowest mods: ' + ', '.join(f'{mod} {seconds:.1f}s' for mod, seconds in slowest))
+
+    def summary(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                'ready': self._ready.is_set(),
+                'time_to_ready': self.time_to_ready,
+                'reported_seconds': self.reported_seconds,
+                'phases': [dict(p) for p in self.phases],
+                'slowest_mods': sorted(self.mods.items(), key=lambda m: m[1], reverse=True)[:SLOWEST_MODS]
+            }
@@ -0,0 +1,273 @@
+from typing import TypedDict, List, Optional, Dict, Iterable
+import os
+import json
+import sqlite3
+import threading
+import logging
+
+DB_FILE = 'backups.db'
+LEGACY_FILE = 'backups.json'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS days (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    time INTEGER NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    day_id INTEGER NOT NULL REFERENCES days(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    mode TEXT NOT NULL DEFAULT 'copy',
+    bytes INTEGER NOT NULL DEFAULT 0,
+    complete INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (day_id, path)
+);
+CREATE INDEX IF NOT EXISTS backups_time ON backups(time);
+CREATE TABLE IF NOT EXISTS files (
+    backup_id INTEGER NOT NULL REFERENCES backups(id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT,
+    verified REAL,
+    verify_ok INTEGER,
+    PRIMARY KEY (backup_id, path)
+);
+CREATE INDEX IF NOT EXISTS files_path ON files(path);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+'''
+
+# Columns added after the first version of the schema
+MIGRATIONS = [
+    ('files', 'verified', 'REAL'),
+    ('files', 'verify_ok', 'INTEGER'),
+]
+
+
+class BackupDay(TypedDict):
+    id: int
+    path: str  # local to the backup path
+    time: int  # days since START_DATE
+
+
+class BackupRecord(TypedDict):
+    id: int
+    day_id: int
+    day_path: str
+    path: str  # local to the day
+    time: int
+    mode: str
+    bytes: int  # bytes this backup added to the backup path
+    complete: int
+
+
+class VerifyItem(TypedDict):
+    backup_id: int
+    day_path: str
+    backup_path: str  # local to the day
+    mode: str
+    path: str
+    size: int
+    hash: Optional[str]
+
+
+class FileRecord(TypedDict):
+    path: str  # local to the backup dir, starts with the world name
+    size: int
+    mtime: int  # ns
+    hash: Optional[str]
+
+
+BACKUP_COLUMNS = 'b.id, b.day_id, d.path AS day_path, b.path, b.time, b.mode, b.bytes, b.complete'
+
+
+class BackupRegistry:
+    def __init__(self, backup_path: str) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.backup_path = backup_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(backup_path, DB_FILE), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            for table, column, type in MIGRATIONS:
+                columns = [row['name'] for row in self._conn.execute(f'PRAGMA table_info({table})')]
+                if column not in columns:
+                    self._conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {type}')
+        self._migrate_json()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _migrate_json(self) -> None:
+        legacy = os.path.join(self.backup_path, LEGACY_FILE)
+        if not os.path.isfile(legacy):
+            return
+        try:
+            with open(legacy, 'r') as input:
+                data = json.loads(input.read())
+        except Exception:
+            self.logger.exception(f'Could not read {legacy}, leaving it in place')
+            return
+
+        with self._lock, self._conn:
+            for day in data.get('backups', []):
+                day_id = self._day_id(day['time'], day['path'])
+                for backup in day['backups']:
+                    self._conn.execute(
+                        'INSERT OR IGNORE INTO backups (day_id, path, time, complete) VALUES (?, ?, ?, 1)',
+                        (day_id, backup['path'], backup['time'])
+                    )
+        os.replace(legacy, f'{legacy}.migrated')
+        self.logger.info(f'Migrated {legacy} into {DB_FILE}')
+
+    def _day_id(self, time: int, path: str) -> int:
+        row = self._conn.execute('SELECT id FROM days WHERE time = ?', (time,)).fetchone()
+        if row:
+            return row['id']
+        return self._conn.execute('INSERT INTO days (path, time) VALUES (?, ?)', (path, time)).lastrowid
+
+    def find_or_create_day(self, time: int, path: str) -> BackupDay:
+        with self._lock, self._conn:
+            day_id = self._day_id(time, path)
+            return dict(self._conn.execute('SELECT * FROM days WHERE id = ?', (day_id,)).fetchone())
+
+    def add_backup(self, day_id: int, path: str, time: int, mode: str) -> int:
+        # Two backups in the same minute share a directory, the newer one replaces the record
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT id FROM backups WHERE day_id = ? AND path = ?', (day_id, path)
+            ).fetchone()
+            if row:
+                self._conn.execute('DELETE FROM files WHERE backup_id = ?', (row['id'],))
+                self._conn.execute(
+                    'UPDATE backups SET time = ?, mode = ?, bytes = 0, complete = 0 WHERE id = ?',
+                    (time, mode, row['id'])
+                )
+                return row['id']
+            return self._conn.execute(
+                'INSERT INTO backups (day_id, path, time, mode) VALUES (?, ?, ?, ?)',
+                (day_id, path, time, mode)
+            ).lastrowid
+
+    def complete_backup(self, backup_id: int, written: int, files: Iterable[FileRecord]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM files WHERE backup_id = ?', (backup_id,))
+            self._conn.executemany(
+                'INSERT INTO files (backup_id, path, name, size, mtime, hash) VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    (backup_id, f['path'], os.path.basename(f['path']), f['size'], f['mtime'], f['hash'])
+                    for f in files
+                )
+            )
+            self._conn.execute(
+                'UPDATE backups SET bytes = ?, complete = 1 WHERE id = ?', (written, backup_id)
+            )
+
+    def _backups(self, where: str = '', args: tuple = ()) -> List[BackupRecord]:
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {BACKUP_COLUMNS} FROM backups b JOIN days d ON d.id = b.day_id {where}', args
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def backups(self) -> List[BackupRecord]:
+        return self._backups('ORDER BY b.time DESC')
+
+    def backup(self, backup_id: int) -> Optional[BackupRecord]:
+        rows = self._backups('WHERE b.id = ?', (backup_id,))
+        return rows[0] if rows else None
+
+    def latest_backup(self, complete_only: bool = False) -> Optional[BackupRecord]:
+        where = 'WHERE b.complete = 1 ' if complete_only else ''
+        rows = self._backups(where + 'ORDER BY b.time DESC LIMIT 1')
+        return rows[0] if rows else None
+
+    def latest_backup_containing(self, path: str) -> Optional[BackupRecord]:
+        # A bare file name like r.3.-2.mca matches it in any directory
+        column = 'f.path' if os.sep in path else 'f.name'
+        rows = self._backups(
+            f'JOIN files f ON f.backup_id = b.id WHERE {column} = ? AND b.complete = 1 '
+            'ORDER BY b.time DESC LIMIT 1',
+            (path,)
+        )
+        return rows[0] if rows else None
+
+    def backups_containing(self, path: str) -> List[BackupRecord]:
+        # Same matching as latest_backup_containing, answered from the indexes on files
+        column = 'path' if os.sep in path else 'name'
+        return self._backups(
+            f'WHERE b.id IN (SELECT backup_id FROM files WHERE {column} = ?) ORDER BY b.time DESC', (path,)
+        )
+
+    def days(self) -> List[BackupDay]:
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM days ORDER BY time DESC').fetchall()
+        return [dict(row) for row in rows]
+
+    def backups_in_day(self, day_id: int) -> List[BackupRecord]:
+        return self._backups('WHERE b.day_id = ? ORDER BY b.time DESC', (day_id,))
+
+    def files(self, backup_id: int) -> Dict[str, FileRecord]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT path, size, mtime, hash FROM files WHERE backup_id = ?', (backup_id,)
+            ).fetchall()
+        return {row['path']: dict(row) for row in rows}
+
+    def files_to_verify(self, checked_before: float, limit: int) -> List[VerifyItem]:
+        # Never checked first, then the longest ago
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT f.backup_id, d.path AS day_path, b.path AS backup_path, b.mode, f.path, f.size, f.hash '
+                'FROM files f JOIN backups b ON b.id = f.backup_id JOIN days d ON d.id = b.day_id '
+                'WHERE b.complete = 1 AND (f.verified IS NULL OR f.verified < ?) '
+                'ORDER BY COALESCE(f.verified, 0), b.time LIMIT ?',
+                (checked_before, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_verified(self, backup_id: int, paths: Iterable[str], time: float, ok: bool) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'UPDATE files SET verified = ?, verify_ok = ? WHERE backup_id = ? AND path = ?',
+                ((time, int(ok), backup_id, path) for path in paths)
+            )
+
+    def verify_failures(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM files WHERE verify_ok = 0').fetchone()[0]
+
+    def bytes_per_day(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT d.path, COALESCE(SUM(b.bytes), 0) AS total FROM days d '
+                'LEFT JOIN backups b ON b.day_id = d.id GROUP BY d.id ORDER BY d.time DESC'
+            ).fetchall()
+        return {row['path']: row['total'] for row in rows}
+
+    def delete_backup(self, backup_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM backups WHERE id = ?', (backup_id,))
+
+    def delete_backups(self, backup_ids: Iterable[int]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM backups WHERE id = ?', ((i,) for i in backup_ids))
+
+    def empty_days(self) -> List[BackupDay]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM days d WHERE NOT EXISTS (SELECT 1 FROM backups b WHERE b.day_id = d.id)'
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_day(self, day_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM days WHERE id = ?', (day_id,))
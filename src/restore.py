@@ -0,0 +1,339 @@
+from typing import List, Optional, Dict, Set, Tuple, Iterator
+import os
+import sys
+import time
+import hashlib
+import argparse
+import datetime
+import logging
+
+import archive
+import backup
+import chunk_store
+from chunk_store import split_region, join_region, SECTOR_SIZE
+from control import send_control
+from registry import BackupRegistry, BackupRecord
+from server_config import load_config, load_instances, control_socket, restore_lock, Config
+
+REGION_CHUNKS = 32
+CHUNK_BLOCKS = 16
+STOP_TIMEOUT = 300
+
+
+class Selection:
+    def __init__(self, world: str) -> None:
+        self.world = world
+        self.files: Set[str] = set()
+        self.prefixes: List[str] = []
+        self.chunks: Dict[str, Set[int]] = {}  # Region file -> chunk indices in it
+        self.players: Dict[str, List[str]] = {}
+
+    def matches(self, rel: str) -> bool:
+        return rel in self.files or rel in self.chunks or any(rel.startswith(p) for p in self.prefixes)
+
+    def _dim_dir(self, dim: Optional[str]) -> str:
+        return os.path.join(self.world, dim) if dim else self.world
+
+    def add_region(self, name: str, dim: Optional[str]) -> None:
+        if not name.endswith('.mca'):
+            name += '.mca'
+        self.files.add(os.path.join(self._dim_dir(dim), 'region', name))
+
+    def add_player(self, player: str) -> None:
+        # playerdata holds files by UUID, players by name on old versions
+        paths = [os.path.join(self.world, folder, f'{player}.dat') for folder in ('playerdata', 'players')]
+        self.players[player] = paths
+        self.files.update(paths)
+
+    def add_dimension(self, dim: str) -> None:
+        self.prefixes.append(os.path.join(self.world, dim) + os.sep)
+
+    def add_area(self, x1: int, z1: int, x2: int, z2: int, dim: Optional[str]) -> None:
+        for cx in range(min(x1, x2) // CHUNK_BLOCKS, max(x1, x2) // CHUNK_BLOCKS + 1):
+            for cz in range(min(z1, z2) // CHUNK_BLOCKS, max(z1, z2) // CHUNK_BLOCKS + 1):
+                name = f'r.{cx // REGION_CHUNKS}.{cz // REGION_CHUNKS}.mca'
+                region = os.path.join(self._dim_dir(dim), 'region', name)
+                index = (cx % REGION_CHUNKS) + (cz % REGION_CHUNKS) * REGION_CHUNKS
+                self.chunks.setdefault(region, set()).add(index)
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _snapshot_files(backup_dir: str, mode: str, selection: Selection,
+                    known: List[str]) -> Iterator[Tuple[str, bytes, bool]]:
+    # Yields (path starting with the world name, contents, partial) for every selected file.
+    # Partial regions only hold the selected chunks
+    world = selection.world
+    if mode == backup.MODE_CHUNKED:
+        manifest = chunk_store.load_manifest(backup_dir)
+        if manifest is None:
+            raise Exception(f'No chunk manifest in {backup_dir}')
+        store_dir = os.path.join(os.path.dirname(os.path.dirname(backup_dir)), chunk_store.STORE_DIR)
+        for entry in manifest['files']:
+            rel = os.path.join(world, entry['path'])
+            # Regions are rebuilt from their chunks with a different layout than the original
+            # file, so they can not be compared to its hash. Each chunk is checked instead
+            if rel in selection.chunks and entry['header']:
+                yield rel, chunk_store.read_chunks(store_dir, entry, selection.chunks[rel]), True
+            elif selection.matches(rel):
+                yield rel, chunk_store.read_file(store_dir, entry), entry['header'] is not None
+    elif mode == backup.MODE_ARCHIVE:
+        groups = {world}
+        for rel in list(selection.files) + list(selection.chunks) + selection.prefixes:
+            parts = rel.split(os.sep)
+            if len(parts) > 2 and parts[1].startswith('DIM'):
+                groups.add(f'{world}_{parts[1]}')
+        for name in sorted(os.listdir(backup_dir)):
+            if name.split('.tar')[0] in groups:
+                for rel, data in archive.read_archive(os.path.join(backup_dir, name), selection.matches):
+                    yield rel, data, False
+    else:
+        if not known:
+            for root, _, files in os.walk(os.path.join(backup_dir, world)):
+                known += [os.path.relpath(os.path.join(root, f), backup_dir) for f in files]
+        for rel in known:
+            if selection.matches(rel):
+                with open(os.path.join(backup_dir, rel), 'rb') as input:
+                    yield rel, input.read(), False
+
+
+def _write(dst: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f'{dst}.restore'
+    with open(tmp, 'wb') as out:
+        out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, dst)
+
+
+def _merge_chunks(live_path: str, data: bytes, indices: Set[int]) -> Tuple[bytes, Dict[int, bytes]]:
+    region = split_region(data)
+    if region is None:
+        raise Exception(f'Could not parse region file from backup: {live_path}')
+    backup_timestamps, backup_chunks = region
+    wanted = {index: chunk for index, chunk in backup_chunks if index in indices}
+
+    timestamps = bytearray(SECTOR_SIZE)
+    chunks: Dict[int, bytes] = {}
+    live_data = b''
+    if os.path.isfile(live_path):
+        with open(live_path, 'rb') as input:
+            live_data = input.read()
+    # The server leaves empty region files around, those have no chunks like a missing one
+    if live_data:
+        live = split_region(live_data)
+        if live is None:
+            raise Exception(f'Could not parse live region file: {live_path}')
+        timestamps[:] = live[0]
+        chunks = dict(live[1])
+
+    # Chunks missing from the backup did not exist yet, so they are removed
+    for index in indices:
+        timestamps[index * 4:index * 4 + 4] = backup_timestamps[index * 4:index * 4 + 4]
+        if index in wanted:
+            chunks[index] = wanted[index]
+        else:
+            chunks.pop(index, None)
+    return join_region(bytes(timestamps), sorted(chunks.items())), wanted
+
+
+def _verify_chunks(path: str, wanted: Dict[int, bytes], indices: Set[int]) -> bool:
+    with open(path, 'rb') as input:
+        region = split_region(input.read())
+    if region is None:
+        return False
+    restored = dict(region[1])
+    return all(
+        (_sha256(restored[i]) == _sha256(wanted[i])) if i in wanted else i not in restored
+        for i in indices
+    )
+
+
+def restore(registry: BackupRegistry, record: BackupRecord, save_path: str,
+            selection: Selection, dry_run: bool = False) -> bool:
+    backup_dir = os.path.join(registry.backup_path, record['day_path'], record['path'])
+    hashes = registry.files(record['id'])
+    root = os.path.dirname(os.path.normpath(save_path))
+    ok = True
+    found: Set[str] = set()
+
+    for rel, data, partial in _snapshot_files(backup_dir, record['mode'], selection, sorted(hashes)):
+        found.add(rel)
+        dst = os.path.join(root, rel)
+        expected = hashes[rel]['hash'] if rel in hashes and not partial else None
+        if expected and _sha256(data) != expected:
+            print(f'CORRUPT {rel}: does not match the hash recorded when it was backed up')
+            ok = False
+            continue
+        if dry_run:
+            print(f'Would restore {rel}')
+            continue
+
+        indices = selection.chunks.get(rel)
+        if indices is not None:
+            merged, wanted = _merge_chunks(dst, data, indices)
+            _write(dst, merged)
+            verified = _verify_chunks(dst, wanted, indices)
+            what = f'{len(indices)} chunks of {rel}'
+        else:
+            _write(dst, data)
+            with open(dst, 'rb') as input:
+                verified = _sha256(input.read()) == (expected or _sha256(data))
+            what = rel
+        print(f'{"Restored" if verified else "FAILED"} {what}')
+        ok = ok and verified
+
+    player_files = {path for paths in selection.players.values() for path in paths}
+    for rel in sorted((selection.files | set(selection.chunks)) - found - player_files):
+        print(f'Not in backup: {rel}')
+    for player, paths in selection.players.items():
+        # Only one of the player folders exists depending on the version
+        if not found.intersection(paths):
+            print(f'Not in backup: player {player}')
+    if not found:
+        print('Nothing in the backup matched')
+        return False
+    return ok
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _server_running(name: str) -> bool:
+    try:
+        next(send_control(control_socket(name), {'cmd': 'status'}))
+        return True
+    except (OSError, StopIteration):
+        return False
+
+
+def stop_server(name: str) -> None:
+    # The server keeps chunks in memory and would write them back over the restored files,
+    # so it has to be fully stopped first. The manager keeps its control socket open until
+    # then, and starts the server again once the restore lock is gone
+    try:
+        reply = next(send_control(control_socket(name), {'cmd': 'stop', 'restore': True}))
+    except (OSError, StopIteration):
+        return
+    if not reply.get('ok'):
+        raise Exception(f'Manager refused to stop: {reply.get("error")}')
+    print('Stopping the running server')
+    deadline = time.monotonic() + STOP_TIMEOUT
+    while _server_running(name):
+        if time.monotonic() > deadline:
+            raise Exception('Timed out waiting for the server to stop')
+        time.sleep(1)
+
+
+def wait_for_restore(lock: str) -> None:
+    # Called by the manager before starting a server, so it waits for a restore
+    if os.path.exists(lock):
+        logging.getLogger(__name__).info('Waiting for a restore to finish')
+    while os.path.exists(lock):
+        try:
+            with open(lock, 'r') as input:
+                pid = int(input.read())
+        except Exception:
+            pid = -1
+        if not _pid_alive(pid):
+            os.remove(lock)
+            return
+        time.sleep(1)
+
+
+def _format_time(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+def list_backups(registry: BackupRegistry, containing: Optional[str]) -> None:
+    records = registry.backups_containing(containing) if containing else registry.backups()
+    for record in records:
+        state = '' if record['complete'] else ' (incomplete)'
+        print(f'{record["id"]:>6}  {_format_time(record["time"])}  {record["mode"]:<12}{state}')
+
+
+def select_instance(instances: List[Config], name: Optional[str]) -> Config:
+    if name is None and len(instances) == 1:
+        return instances[0]
+    for instance in instances:
+        if instance['name'] == name:
+            return instance
+    names = ', '.join(i['name'] for i in instances)
+    print(f'Pick a server with --instance: {names}' if name is None else f'No instance named "{name}", have {names}')
+    sys.exit(1)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Restore parts of the world from a backup')
+    parser.add_argument('--instance', help='Server to restore when config.json has instances')
+    parser.add_argument('--backup', type=int, help='Backup id from "list", defaults to the newest')
+    parser.add_argument('--dim', help='Dimension folder for region and area, e.g. DIM-1')
+    parser.add_argument('--dry-run', action='store_true', help='Only print what would be restored')
+    sub = parser.add_subparsers(dest='what', required=True)
+    listing = sub.add_parser('list', help='List backups')
+    listing.add_argument('--containing', help='Only backups with this file, e.g. r.3.-2.mca')
+    sub.add_parser('region', help='Whole region files').add_argument('names', nargs='+', help='e.g. r.3.-2')
+    area = sub.add_parser('area', help='Chunks overlapping a block coordinate range')
+    for name in ('x1', 'z1', 'x2', 'z2'):
+        area.add_argument(name, type=int)
+    sub.add_parser('player', help='Player .dat files').add_argument('players', nargs='+', help='UUIDs or names')
+    sub.add_parser('dim', help='A whole dimension folder').add_argument('dim', help='e.g. DIM1')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    config = select_instance(load_instances(load_config()), args.instance)
+    registry = BackupRegistry(config['backup_path'])
+    if args.what == 'list':
+        list_backups(registry, args.containing)
+        return
+
+    record = registry.backup(args.backup) if args.backup else registry.latest_backup(complete_only=True)
+    if not record or not record['complete']:
+        print('No such complete backup, see "restore.py list"')
+        sys.exit(1)
+    print(f'Restoring from backup {record["id"]} taken {_format_time(record["time"])}')
+
+    selection = Selection(os.path.basename(os.path.normpath(config['save_path'])))
+    if args.what == 'region':
+        for name in args.names:
+            selection.add_region(name, args.dim)
+    elif args.what == 'area':
+        selection.add_area(args.x1, args.z1, args.x2, args.z2, args.dim)
+    elif args.what == 'player':
+        for player in args.players:
+            selection.add_player(player)
+    else:
+        selection.add_dimension(args.dim)
+
+    if args.dry_run:
+        ok = restore(registry, record, config['save_path'], selection, dry_run=True)
+        sys.exit(0 if ok else 1)
+
+    lock = restore_lock(config['name'])
+    with open(lock, 'w') as out:
+        out.write(str(os.getpid()))
+    try:
+        stop_server(config['name'])
+        ok = restore(registry, record, config['save_path'], selection)
+    finally:
+        os.remove(lock)
+    if not ok:
+        print('Restore finished with errors')
+        sys.exit(1)
+    print('Restore complete, a running manager starts the server again')
+
+
+if __name__ == '__main__':
+    main()
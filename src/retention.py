@@ -0,0 +1,81 @@
+from typing import TypedDict, List, Set, Dict, Tuple, Callable, Hashable, Optional
+import datetime
+
+from registry import BackupRecord
+
+GB = 1024 * 1024 * 1024
+
+
+class RetentionPolicy(TypedDict):
+    last: int  # Most recent backups kept no matter their age
+    hourly: int
+    daily: int
+    weekly: int
+    monthly: int
+    max_total_gb: float  # 0 for no cap
+
+
+DEFAULT_RETENTION: RetentionPolicy = {
+    'last': 5,
+    'hourly': 24,
+    'daily': 7,
+    'weekly': 4,
+    'monthly': 6,
+    'max_total_gb': 0
+}
+
+Bucket = Callable[[datetime.datetime], Hashable]
+# Bytes on disk of each piece of storage a backup uses, keyed so that pieces shared between
+# backups (hard linked files, chunks) have the same key
+Footprint = Callable[[BackupRecord], Dict[Hashable, int]]
+
+TIERS: List[Tuple[str, Bucket]] = [
+    ('hourly', lambda t: (t.date(), t.hour)),
+    ('daily', lambda t: t.date()),
+    ('weekly', lambda t: t.isocalendar()[:2]),
+    ('monthly', lambda t: (t.year, t.month)),
+]
+
+
+def _added_bytes(backup: BackupRecord) -> Dict[Hashable, int]:
+    # Only right when backups share nothing, the real footprint should be passed otherwise
+    return {backup['id']: backup['bytes']}
+
+
+def select(backups: List[BackupRecord], policy: RetentionPolicy,
+           footprint: Optional[Footprint] = None) -> Set[int]:
+    # Grandfather-father-son: each tier keeps the newest backup of each of its most recent
+    # periods. All tiers are filled in one pass over the backups from newest to oldest
+    ordered = sorted((b for b in backups if b['complete']), key=lambda b: b['time'], reverse=True)
+    keep: List[BackupRecord] = []
+    last_bucket = {name: None for name, _ in TIERS}
+    counts = {name: 0 for name, _ in TIERS}
+    for i, backup in enumerate(ordered):
+        when = datetime.datetime.fromtimestamp(backup['time'])
+        kept = i < policy['last']
+        for name, bucket in TIERS:
+            key = bucket(when)
+            if key != last_bucket[name] and counts[name] < policy[name]:
+                last_bucket[name] = key
+                counts[name] += 1
+                kept = True
+        if kept:
+            keep.append(backup)
+
+    # Shared storage is counted once, for the newest backup using it, so the total is what
+    # the newest i backups take on disk together. The newest backup is always kept
+    if policy['max_total_gb'] > 0:
+        cap = policy['max_total_gb'] * GB
+        measure = footprint or _added_bytes
+        counted: Set[Hashable] = set()
+        total = 0
+        for i, backup in enumerate(keep):
+            for key, size in measure(backup).items():
+                if key not in counted:
+                    counted.add(key)
+                    total += size
+            if total > cap and i > 0:
+                keep = keep[:i]
+                break
+
+    return {backup['id'] for backup in keep}
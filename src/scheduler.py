@@ -0,0 +1,69 @@
+from typing import Callable, List, Tuple
+import datetime
+import heapq
+import itertools
+import random
+import threading
+import logging
+
+from server import Server
+
+# Returns the number of seconds until the task should run again
+TaskFn = Callable[[], float]
+
+IDLE_WAIT = 60 * 60
+
+
+class Task:
+    def __init__(self, name: str, run: TaskFn, generation: int) -> None:
+        self.name = name
+        self.run = run
+        self.generation = generation
+
+
+class Scheduler:
+    def __init__(self, jitter: float = 0) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.jitter = jitter
+        self._heap: List[Tuple[float, int, Task]] = []
+        self._counter = itertools.count()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _push(self, due: float, task: Task) -> None:
+        if self.jitter > 0:
+            due += random.uniform(0, self.jitter)
+        heapq.heappush(self._heap, (due, next(self._counter), task))
+
+    def add(self, name: str, run: TaskFn, delay: float) -> None:
+        with self._lock:
+            self._push(datetime.datetime.now().timestamp() + delay, Task(name, run, self._generation))
+
+    def clear(self) -> None:
+        # A task that is running right now is dropped instead of rescheduled when it finishes
+        with self._lock:
+            self._heap = []
+            self._generation += 1
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def next_due(self) -> float:
+        return self._heap[0][0] if self._heap else float('inf')
+
+    def run(self, server: Server) -> None:
+        while server.should_run():
+            now = datetime.datetime.now().timestamp()
+            with self._lock:
+                due = self.next_due()
+                task = heapq.heappop(self._heap)[2] if due <= now else None
+            if not task:
+                # Wakes up early when the server is killed or the tasks change
+                server.sleep(min(due - now, IDLE_WAIT))
+                continue
+
+            start = datetime.datetime.now().timestamp()
+            delay = task.run()
+            with self._lock:
+                if task.generation == self._generation:
+                    self._push(start + delay, task)
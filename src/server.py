@@ -1,61 +1,143 @@
-from typing import Optional, TextIO, List
+from typing import List, Optional, Iterator, Dict, Any
+from concurrent.futures import TimeoutError as FutureTimeout
 import subprocess
-import time
-import signal
+import os
+import re
+import queue
 import datetime
 import threading
 import logging
 
-from server_config import kill_file, Config
+from server_config import control_socket, Config
 import backup
+from log_follower import LineSource
+from commands import CommandDispatcher, PendingCommand, Matcher, TooManyLines
+from rcon import RconClient
+from presence import PresenceTracker
+from control import ControlServer
+from backup_worker import BackupWorker, BackupStatus, Priority, IOPRIO_CLASS_BE, IOPRIO_CLASS_IDLE
+from tps import TickMonitor
+from verifier import BackupVerifier
+from readiness import Readiness
+from watchdog import Watchdog
+import metrics
 
 MAX_LINES = 10000
 
+# Anchored on the logger prefix so player chat repeating the text can not match
+SAVE_OFF_MSG = re.compile(r'\]: Turned off world auto-saving')
+SAVE_ALL_MSG = re.compile(r'\]: Saved the world')
+SAVE_ON_MSG = re.compile(r'\]: Turned on world auto-saving')
+LIST_MSG = re.compile(r'\]: There are \d+/\d+ players online:')
+
+_save_seconds = metrics.histogram('server_save_game_seconds', 'Time from save-off to handing the backup to the worker')
+_save_off_seconds = metrics.histogram('server_save_off_seconds', 'Time world saving stays turned off during a backup')
+_command_seconds = metrics.histogram('server_command_seconds', 'Round trip of console commands that wait for a reply')
+_wait_seconds = metrics.histogram('server_wait_for_output_seconds', 'Time spent waiting for console output')
+_command_failures = metrics.counter('server_command_failures_total', 'Console commands that failed or timed out')
+_backups_finished = metrics.counter('server_backups_total', 'Finished backups by result')
+_backup_seconds = metrics.gauge('server_last_backup_seconds', 'Duration of the last finished backup')
+
 
 class CommandTimeout(Exception):
     pass
 
 
 class Server:
-    def __init__(self, config: Config, process: subprocess.Popen, server_log: TextIO) -> None:
+    def __init__(self, config: Config, process: subprocess.Popen, server_log: LineSource,
+                 presence: Optional[PresenceTracker] = None) -> None:
         self.logger = logging.getLogger(__name__)
         self.config = config
+        # Labels the metrics of this server, several can run in one manager
+        self.name = config['name']
         self.server_log = server_log
         self.process = process
         self.killed = False
+        self.stopped_for_restore = False
+        self.started = datetime.datetime.now().timestamp()
+        self.readiness: Optional[Readiness] = None
+        self.commands = CommandDispatcher(self._write_stdin, server_log, MAX_LINES)
+        self.presence = presence or PresenceTracker()
+        self.presence.attach(server_log)
+        self.rcon: Optional[RconClient] = None
+        if config['command_transport'] == 'rcon':
+            self.rcon = RconClient(config['rcon_host'], config['rcon_port'], config['rcon_password'])
         self._cond = threading.Condition()
-        self._thread = threading.Thread(target=self._pipe_reader)
-        self._thread.start()
+        self._save_lock = threading.Lock()
+        self.ticks = TickMonitor(
+            self, config['tps_window'], config['tps_lag_mspt'], config['tps_command'], self.name
+        )
+        self.watchdog = Watchdog(
+            self,
+            config['watchdog_timeout'],
+            config['watchdog_failures'],
+            config['watchdog_log_silence'],
+            os.path.join(config['server_path'], 'manager_logs'),
+            self.name
+        )
+        self.backup_worker = BackupWorker(self._on_backup_complete, self._backup_priority)
+        self.verifier = BackupVerifier(
+            backup.get_registry(config['backup_path']),
+            config['backup_verify_mb_per_hour'] * backup.MB,
+            # Also waits for the backups of other servers
+            lambda: self.ticks.is_lagging() or self.backup_worker.busy() or backup.finalize_lock.locked(),
+            self.name
+        )
+        self.control = ControlServer(control_socket(config['name']))
+        self.control.register('stop', self._on_stop_request)
+        self.control.register('status', lambda _: {'ok': True, **self.status()})
+        self.control.register('backup', self._on_backup_request)
+        self.control.register('command', self._on_command_request)
+        self.control.start()
 
-        signal.signal(signal.SIGTERM, self._on_kill)
-        signal.signal(signal.SIGINT, self._on_kill)
+    def _on_stop_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if request.get('restore'):
+            self.logger.info('Stopped for a restore')
+            self.stopped_for_restore = True
+        else:
+            self.logger.info('Killed by stop.py')
+        self.kill()
+        return {'ok': True}
 
-    def _pipe_reader(self) -> None:
-        self.logger.info('Started shutdown listener')
-        while not self.killed:
-            time.sleep(1)
-            try:
-                now = datetime.datetime.now().timestamp()
-                with open(kill_file(), 'r') as kf:
-                    line = kf.readline()
-                    while line:
-                        ts = float(line)
-                        if ts >= now:
-                            self.logger.info('Killed by stop.py')
-                            self._do_kill()
-                            break
-                        line = kf.readline()
-            except Exception:
-                continue
-
-    def _do_kill(self) -> None:
+    def _on_backup_request(self, _: Dict[str, Any]) -> Dict[str, Any]:
+        self.logger.info('Backup requested over control socket')
+        self.save_game()
+        return {'ok': True, 'backup': self.backup_worker.status()}
+
+    def _on_command_request(self, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        command = request.get('command') or request.get('args')
+        if not command:
+            raise Exception('No command given')
+        return ({'ok': True, 'line': line} for line in self.relay_command(command, request.get('timeout', 10)))
+
+    def status(self) -> Dict[str, Any]:
+        backup_status = self.backup_worker.status()
+        return {
+            'uptime': datetime.datetime.now().timestamp() - self.started,
+            'alive': self.server_alive(),
+            'startup': self.readiness.summary() if self.readiness else None,
+            'killed': self.killed,
+            'players': self.presence.players(),
+            'mspt': self.ticks.mean_mspt(),
+            'watchdog': self.watchdog.summary(),
+            'backup': backup_status,
+            'verify_failures': self.verifier.registry.verify_failures(),
+            'queue_depth': {
+                'backups': backup_status['pending'],
+                'commands': self.commands.in_flight()
+            }
+        }
+
+    def kill(self) -> None:
+        # Stops the scheduler, the server itself is stopped by whoever runs it
         self.killed = True
         self._cond.acquire()
         self._cond.notify_all()
         self._cond.release()
 
-    def _on_kill(self, _1, _2) -> None:
-        self._do_kill()
+    def wake(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
 
     def sleep(self, secs: float) -> None:
         self._cond.acquire()
@@ -64,11 +146,18 @@ class Server:
 
     def stop(self) -> None:
         self.killed = True
-        self._thread.join()
         if self.server_alive():
-            self.process.stdin.write('stop\n')
-            self.process.stdin.flush()
+            self._write_stdin('stop\n')
         self.process.wait()
+        # Only goes away once the server is gone, restore.py waits for that
+        self.control.stop()
+        self.commands.close()
+        self.presence.detach()
+        self.watchdog.detach()
+        if self.rcon:
+            self.rcon.close()
+        self.backup_worker.stop()
+        self.verifier.stop()
 
     def server_alive(self) -> bool:
         return self.process.poll() is None
@@ -76,61 +165,161 @@ class Server:
     def should_run(self) -> bool:
         return not self.killed and self.server_alive()
 
-    def wait_for_output(self, success_msg: str, timeout: float = 30, return_next_line: bool = False) -> str:
-        self.logger.info(f'Waiting for msg: {success_msg}')
-        lines = 1
-        output = ''
-        wait_start: Optional[int] = None
-        found = False
-        while return_next_line or success_msg not in output:
-            if not self.server_alive() or self.killed:
-                raise Exception('Killed or died while waiting')
-            output = self.server_log.readline()
-            if not output:
-                if not wait_start:
-                    wait_start = datetime.datetime.now().timestamp()
-                else:
-                    if datetime.datetime.now().timestamp() - wait_start > timeout:
-                        raise CommandTimeout(
-                            f'Timed out while waiting for output: {success_msg}'
-                        )
-                time.sleep(1)
-            else:
-                if found:
-                    return output
-                if success_msg in output:
-                    found = True
-                wait_start = None
-                lines += 1
-                if lines >= MAX_LINES:
+    def _write_stdin(self, data: str) -> None:
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def _wait_for(self, pending: PendingCommand, timeout: float) -> str:
+        self.logger.info(f'Waiting for msg: {pending.matcher.pattern}')
+        deadline = datetime.datetime.now().timestamp() + timeout
+        try:
+            while True:
+                if not self.server_alive() or self.killed:
+                    raise Exception('Killed or died while waiting')
+                remaining = deadline - datetime.datetime.now().timestamp()
+                if remaining <= 0:
+                    raise CommandTimeout(
+                        f'Timed out while waiting for output: {pending.describe()}'
+                    )
+                try:
+                    return pending.future.result(timeout=min(remaining, 1))
+                except FutureTimeout:
+                    continue
+                except TooManyLines:
                     if self.server_alive():
                         self.process.kill()
-                    raise Exception(
-                        f'Exceeded {MAX_LINES} logs before finding desired output: "{success_msg}"')
-        return output
+                    raise
+        finally:
+            self.commands.cancel(pending)
 
-    def send_command(self, command: str, success_msg: str, return_next_line: bool = False) -> str:
+    def wait_for_output(self, success_msg: Matcher, timeout: float = 30, return_next_line: bool = False) -> str:
+        with _wait_seconds.time(instance=self.name):
+            return self._wait_for(self.commands.expect(success_msg, return_next_line), timeout)
+
+    def send_command(self, command: str, success_msg: Matcher, return_next_line: bool = False,
+                     timeout: float = 30) -> str:
         self.logger.info(f'Running command: {command}')
-        self.process.stdin.write(f'{command}\n')
-        self.process.stdin.flush()
-        if not success_msg:
-            return ''
-        return self.wait_for_output(success_msg, return_next_line=return_next_line)
+        name = command.split(' ')[0]
+        start = datetime.datetime.now().timestamp()
+        try:
+            if self.rcon:
+                # RCON responses are tied to the request id so there is nothing to search for
+                output = self.rcon.command(command)
+            else:
+                pending = self.commands.submit(command, success_msg, return_next_line)
+                if not pending:
+                    return ''
+                output = self._wait_for(pending, timeout)
+        except Exception:
+            _command_failures.inc(command=name, instance=self.name)
+            raise
+        _command_seconds.observe(datetime.datetime.now().timestamp() - start, command=name, instance=self.name)
+        return output
+
+    def send_commands(self, commands: List[str], success_msg: Matcher = None, timeout: float = 30) -> List[str]:
+        self.logger.info(f'Running commands: {", ".join(commands)}')
+        if self.rcon:
+            return self.rcon.commands(commands)
+        batch = self.commands.submit_batch([(command, success_msg, False) for command in commands])
+        return [self._wait_for(pending, timeout) if pending else '' for pending in batch]
+
+    def relay_command(self, command: str, timeout: float = 10, quiet: float = 1) -> Iterator[str]:
+        # Yields console output after the command until it goes quiet or the timeout passes
+        if self.rcon:
+            yield self.rcon.command(command)
+            return
+
+        lines: 'queue.Queue[str]' = queue.Queue()
+        self.server_log.subscribe(lines.put)
+        try:
+            self.logger.info(f'Relaying command: {command}')
+            self.commands.submit(command, None)
+            end = datetime.datetime.now().timestamp() + timeout
+            while datetime.datetime.now().timestamp() < end:
+                try:
+                    yield lines.get(timeout=quiet).rstrip('\n')
+                except queue.Empty:
+                    return
+        finally:
+            self.server_log.unsubscribe(lines.put)
+
+    def _backup_priority(self) -> Priority:
+        if self.ticks.is_lagging():
+            return (19, IOPRIO_CLASS_IDLE, 0)
+        return (self.config['backup_nice'], IOPRIO_CLASS_BE, 7)
+
+    def _on_backup_complete(self, status: BackupStatus) -> None:
+        _backup_seconds.set(status['last_duration'], instance=self.name)
+        if status['last_error']:
+            _backups_finished.inc(result='failed', instance=self.name)
+            self.logger.error(f'Backup failed: {status["last_error"]}')
+        else:
+            _backups_finished.inc(result='ok', instance=self.name)
+            self.logger.info(f'Backup finished in {status["last_duration"]:.1f}s')
 
     def save_game(self) -> None:
-        self.send_command('save-off', 'Turned off world auto-saving')
-        self.send_command('save-all', 'Saved the world')
-        backup.take_backup(self.config['save_path'], self.config['backup_path'])
-        self.send_command('save-on', 'Turned on world auto-saving')
+        with self._save_lock, _save_seconds.time(instance=self.name):
+            self._save_game()
+
+    def _save_game(self) -> None:
+        if not self.backup_worker.wait_idle(0):
+            self.logger.info('Waiting for previous backup to finish')
+            self.backup_worker.wait_idle()
+
+        if not backup.snapshot_lock.acquire(blocking=False):
+            self.logger.info('Waiting for another server to finish its snapshot')
+            backup.snapshot_lock.acquire()
+        try:
+            # Only the capture runs with saving off, the rest happens on the backup worker
+            save_off = datetime.datetime.now().timestamp()
+            try:
+                self.send_command('save-off', SAVE_OFF_MSG)
+                self.send_command('save-all', SAVE_ALL_MSG)
+                snapshot = backup.capture(
+                    self.config['save_path'],
+                    self.config['backup_path'],
+                    self.config['backup_mode'],
+                    {
+                        'compression': self.config['backup_compression'],
+                        'level': self.config['backup_compression_level'],
+                        'workers': self.config['backup_workers']
+                    }
+                )
+            finally:
+                # Also when the save or capture failed, or the world would stay unsaved until the
+                # next backup that works
+                self.send_command('save-on', SAVE_ON_MSG)
+            _save_off_seconds.observe(datetime.datetime.now().timestamp() - save_off, instance=self.name)
+        finally:
+            backup.snapshot_lock.release()
+        self.backup_worker.submit(snapshot)
 
     def get_players(self) -> List[str]:
+        # Join/leave lines keep the tracker current, list is only sent now and then to correct drift
+        if self.presence.needs_sync(self.config['presence_sync_interval']):
+            self.sync_players()
+        return self.presence.players()
+
+    def sync_players(self, timeout: float = 30) -> None:
+        # Also the watchdog heartbeat when tick times are not being sampled
+        players = self._list_players(timeout)
+        if players is not None:
+            self.presence.sync(players)
+
+    def _list_players(self, timeout: float) -> Optional[List[str]]:
         MARKER = 'DedicatedServer]:'
 
-        output = self.send_command('list', ' players online:', True)
+        output = self.send_command('list', LIST_MSG, True, timeout)
+        if self.rcon:
+            # Comes back as a single body: "There are 1/20 players online:name1, name2"
+            _, _, line = output.partition('online:')
+            players = [s.strip() for s in line.replace('\n', ', ').split(', ')]
+            return [p for p in players if p]
+
         si = output.find(MARKER)
         if si < 0:
             self.logger.error(f'Failed to find player list in output: {output}')
-            return []
+            return None
 
         line = output[si+len(MARKER):]
         players = [s.strip() for s in line.split(', ')]
@@ -1,5 +1,6 @@
-from typing import TypedDict, List, Optional
+from typing import TypedDict, List, Optional, Dict, Any
 import os
+import copy
 import json
 import logging
 
@@ -27,12 +28,63 @@ class Effect(TypedDict):
 
 
 class Config(TypedDict):
+    name: str  # Computed, empty unless the config has instances
+    instances: List[Dict[str, Any]]  # Servers to run, each overriding the keys it sets. Empty for just this one
+
     server_path: str
     start_command: List[str]
     save_path: str  # Computed
     
+    log_source: str  # file, stdout
+
+    command_transport: str  # stdin, rcon
+    rcon_host: str
+    rcon_port: int
+    rcon_password: str
+
     backup_path: str
     backup_interval: int
+    backup_mode: str  # copy, incremental, chunked, archive
+    backup_compression: str  # zstd, gzip, xz. zstd needs the zstandard package
+    backup_compression_level: int
+    backup_workers: int
+    backup_rate_limit_mb: float  # MB/s, 0 for no limit. Shared by all instances
+    backup_fadvise: bool
+    backup_reflink: bool  # Used when the backup filesystem supports it
+    backup_keep_last: int
+    backup_keep_hourly: int
+    backup_keep_daily: int
+    backup_keep_weekly: int
+    backup_keep_monthly: int
+    backup_max_total_gb: float  # 0 for no cap
+    backup_copy_threads: int
+    backup_verify_mb_per_hour: float  # 0 to disable
+
+    startup_timeout: int
+    restart_delay: int  # First restart after a crash, doubles on each crash after that
+    restart_max_delay: int
+    crash_loop_restarts: int  # Crashes within crash_loop_window that count as a crash loop
+    crash_loop_window: int
+    crash_loop_delay: int
+
+    watchdog_interval: int  # 0 to disable
+    watchdog_timeout: int
+    watchdog_failures: int  # Failed heartbeats in a row before the server is killed
+    watchdog_log_silence: int  # 0 to ignore log output
+
+    metrics_port: int  # 0 to disable
+    metrics_file: str  # Empty to disable
+    metrics_interval: int
+
+    scheduler_jitter: int
+
+    tps_interval: int  # 0 to disable
+    tps_command: str
+    tps_window: int  # Number of samples to average
+    tps_lag_mspt: float
+    tps_max_backup_defer: int
+    backup_nice: int
+    presence_sync_interval: int
 
     phrase_interval: int
     phrases: List[str]
@@ -50,11 +102,61 @@ class Config(TypedDict):
 
 
 DEFAULT_CONFIG: Config = {
+    'instances': [],
+
     'server_path': '/galacticraft',
     'start_command': ['java', '-Xmx8G', '-Dfml.queryResult=confirm', '-jar', 'forge_server.jar', 'nogui'],
 
+    'log_source': 'file',
+
+    'command_transport': 'stdin',
+    'rcon_host': '127.0.0.1',
+    'rcon_port': 25575,
+    'rcon_password': '',
+
     'backup_path': '/home/ben/Dropbox/Galacticraft/Backups',
     'backup_interval': 20 * 60,
+    'backup_mode': 'incremental',
+    'backup_compression': 'zstd',
+    'backup_compression_level': 3,
+    'backup_workers': 4,
+    'backup_rate_limit_mb': 0,
+    'backup_fadvise': True,
+    'backup_reflink': True,
+    'backup_keep_last': 5,
+    'backup_keep_hourly': 24,
+    'backup_keep_daily': 7,
+    'backup_keep_weekly': 4,
+    'backup_keep_monthly': 6,
+    'backup_max_total_gb': 0,
+    'backup_copy_threads': 4,
+    'backup_verify_mb_per_hour': 1024,
+
+    'startup_timeout': 180,
+    'restart_delay': 5,
+    'restart_max_delay': 5 * 60,
+    'crash_loop_restarts': 5,
+    'crash_loop_window': 15 * 60,
+    'crash_loop_delay': 30 * 60,
+
+    'watchdog_interval': 60,
+    'watchdog_timeout': 30,
+    'watchdog_failures': 3,
+    'watchdog_log_silence': 5 * 60,
+
+    'metrics_port': 0,
+    'metrics_file': '',
+    'metrics_interval': 60,
+
+    'scheduler_jitter': 30,
+
+    'tps_interval': 60,
+    'tps_command': 'forge tps',
+    'tps_window': 5,
+    'tps_lag_mspt': 45.0,
+    'tps_max_backup_defer': 10 * 60,
+    'backup_nice': 10,
+    'presence_sync_interval': 30 * 60,
 
     'phrase_interval': 40 * 60,
     'phrases': [
@@ -209,6 +311,10 @@ DEFAULT_CONFIG: Config = {
 }
 
 
+# Settings of the manager process itself, instances can not override these
+GLOBAL_KEYS = ['instances', 'backup_rate_limit_mb', 'metrics_port', 'metrics_file', 'metrics_interval']
+
+
 def merge_configs(existing: Config) -> None:
     for key, value in DEFAULT_CONFIG.items():
         if isinstance(value, dict) and key in existing and isinstance(DEFAULT_CONFIG[key], dict):
@@ -222,12 +328,21 @@ def config_dir() -> str:
     return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config')
 
 
+def instance_dir(name: str = '') -> str:
+    # A single server keeps its files directly in the config dir
+    return os.path.join(config_dir(), 'instances', name) if name else config_dir()
+
+
 def pid_file() -> str:
     return os.path.join(config_dir(), 'pid.txt')
 
 
-def kill_file() -> str:
-    return os.path.join(config_dir(), 'kill.txt')
+def control_socket(name: str = '') -> str:
+    return os.path.join(instance_dir(name), 'control.sock')
+
+
+def restore_lock(name: str = '') -> str:
+    return os.path.join(instance_dir(name), 'restore.lock')
 
 
 def write_config(config: Config) -> None:
@@ -236,6 +351,15 @@ def write_config(config: Config) -> None:
         cfg.write(json.dumps(config, indent=4))
 
 
+def _read_save_path(config: Config) -> str:
+    with open(os.path.join(config['server_path'], 'server.properties')) as props:
+        items = props.read().split('\n')
+        for item in items:
+            if 'level-name' in item:
+                return os.path.join(config['server_path'], item.split('=')[1])
+    raise Exception(f'No level-name in {config["server_path"]}/server.properties')
+
+
 def load_config(logger: Optional[logging.Logger] = None) -> Config:
     if not logger:
         logger = logging.getLogger(__name__)
@@ -248,20 +372,48 @@ def load_config(logger: Optional[logging.Logger] = None) -> Config:
     with open(config_path, 'r') as cfg:
         config: Config = json.loads(cfg.read())
         try:
-            with open(os.path.join(config['server_path'], 'server.properties')) as props:
-                items = props.read().split('\n')
-                for item in items:
-                    if 'level-name' in item:
-                        config['save_path'] = os.path.join(config['server_path'], item.split('=')[1])
-                        break
-
             merge_configs(config)
             write_config(config)
+            config['name'] = ''
+            if not config['instances']:
+                config['save_path'] = _read_save_path(config)
             return config
         except Exception:
             logger.exception('Bad config, failed to load server properties')
             raise
 
 
+def load_instances(config: Config) -> List[Config]:
+    # Each instance is the top level config with its own keys on top
+    if not config['instances']:
+        return [config]
+
+    instances: List[Config] = []
+    for overrides in config['instances']:
+        name = overrides.get('name')
+        if not name or os.sep in name:
+            raise Exception(f'Instances need a name usable as a directory: {name}')
+        instance: Config = copy.deepcopy({k: v for k, v in config.items() if k != 'instances'})
+        instance.update({k: v for k, v in overrides.items() if k not in GLOBAL_KEYS})
+        instance['instances'] = []
+        instance['save_path'] = _read_save_path(instance)
+        instances.append(instance)
+
+    for key in ('name', 'server_path', 'backup_path'):
+        values = [i[key] for i in instances]
+        if len(set(values)) != len(values):
+            raise Exception(f'Instances must not share a {key}')
+    for instance in instances:
+        os.makedirs(instance_dir(instance['name']), exist_ok=True)
+    return instances
+
+
+def load_instance(name: str) -> Config:
+    for instance in load_instances(load_config()):
+        if instance['name'] == name:
+            return instance
+    raise Exception(f'No instance named "{name}" in config.json')
+
+
 if __name__ == '__main__':
     load_config()
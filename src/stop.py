@@ -1,13 +1,29 @@
-from datetime import datetime
+import sys
 
-from server_config import kill_file
+from server_config import control_socket, load_config, load_instances
+from control import send_control
+
+
+def stop(name: str) -> bool:
+    label = f'"{name}"' if name else 'server'
+    try:
+        reply = next(send_control(control_socket(name), {'cmd': 'stop'}))
+    except OSError as e:
+        print(f'Failed to reach the manager of {label}, is it running? {e}')
+        return False
+    if not reply.get('ok'):
+        print(f'Stop of {label} failed: {reply.get("error")}')
+        return False
+    print(f'Shutdown of {label} started')
+    return True
 
 
 def main():
-    with open(kill_file(), 'w') as kf:
-        kf.writelines([
-            str(datetime.now().timestamp() + 10)
-        ])
+    # Stops every server unless some are named
+    names = sys.argv[1:] or [i['name'] for i in load_instances(load_config())]
+    results = [stop(name) for name in names]
+    if not all(results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+from typing import Callable, Deque
+import collections
+import threading
+import time
+import logging
+
+import metrics
+
+_restarts = metrics.counter('manager_restarts_total', 'Server restarts by the supervisor')
+_crash_loop = metrics.gauge('manager_crash_loop', '1 while restarts are slowed down by crash loop detection')
+_uptime = metrics.histogram(
+    'server_run_seconds', 'How long the server ran before it stopped or crashed',
+    (60, 300, 900, 3600, 4 * 3600, 12 * 3600, 24 * 3600, 7 * 24 * 3600)
+)
+
+# Runs the server once. Returns True if it should be restarted
+RunFn = Callable[[], bool]
+
+
+class Supervisor:
+    def __init__(self, run: RunFn, delay: float, max_delay: float, crash_loop_restarts: int,
+                 crash_loop_window: float, crash_loop_delay: float, name: str = '') -> None:
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.run_once = run
+        self.delay = delay
+        self.max_delay = max_delay
+        self.crash_loop_restarts = crash_loop_restarts
+        self.crash_loop_window = crash_loop_window
+        self.crash_loop_delay = crash_loop_delay
+        self.crashes: Deque[float] = collections.deque()
+        self.failures = 0
+        self._stopped = threading.Event()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def stopping(self) -> bool:
+        return self._stopped.is_set()
+
+    def next_delay(self, now: float, ran_for: float) -> float:
+        # A run that lasted a whole window was healthy, so backoff starts over
+        if ran_for >= self.crash_loop_window:
+            self.failures = 0
+        self.failures += 1
+        self.crashes.append(now)
+        while self.crashes and now - self.crashes[0] > self.crash_loop_window:
+            self.crashes.popleft()
+
+        if len(self.crashes) >= self.crash_loop_restarts:
+            _crash_loop.set(1, instance=self.name)
+            self.logger.error(
+                f'Server crashed {len(self.crashes)} times in {self.crash_loop_window:.0f}s, '
+                f'waiting {self.crash_loop_delay:.0f}s before the next attempt'
+            )
+            return self.crash_loop_delay
+        _crash_loop.set(0, instance=self.name)
+        return min(self.max_delay, self.delay * 2 ** (self.failures - 1))
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            try:
+                restart = self.run_once()
+            except Exception:
+                self.logger.exception('Server run failed')
+                restart = True
+            ran_for = time.monotonic() - start
+            _uptime.observe(ran_for, instance=self.name)
+            if not restart or self._stopped.is_set():
+                return
+
+            delay = self.next_delay(time.monotonic(), ran_for)
+            _restarts.inc(instance=self.name)
+            self.logger.warning(f'Server stopped unexpectedly after {ran_for:.0f}s, restarting in {delay:.0f}s')
+            if self._stopped.wait(delay):
+                return
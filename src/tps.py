@@ -0,0 +1,86 @@
+from typing import TypedDict, Optional, Deque
+import collections
+import datetime
+import time
+import re
+import logging
+
+import metrics
+
+# Forge prints one line per dimension and then "Overall : Mean tick time: 3.21 ms. Mean TPS: 20.000"
+FORGE_TPS_MSG = re.compile(r'Overall\s*:\s*Mean tick time:\s*([\d.]+)\s*ms\.?\s*Mean TPS:\s*([\d.]+)')
+
+TICK_MS = 50.0
+# Consecutive failed samples before backing off, e.g. on a server without the command
+MAX_FAILURES = 3
+BACKOFF_FACTOR = 60
+
+_mspt = metrics.gauge('server_mspt', 'Mean milliseconds per tick from the last sample')
+_tps = metrics.gauge('server_tps', 'Mean ticks per second from the last sample')
+
+
+class TickSample(TypedDict):
+    time: float
+    mspt: float
+    tps: float
+
+
+class TickMonitor:
+    def __init__(self, server, window: int, lag_mspt: float, command: str = 'forge tps', name: str = '') -> None:
+        self.logger = logging.getLogger(__name__)
+        self.server = server
+        self.name = name
+        self.lag_mspt = lag_mspt
+        self.command = command
+        self.samples: Deque[TickSample] = collections.deque(maxlen=max(1, window))
+        self.failures = 0
+        # When the server last answered and how long it took, the watchdog uses it as a heartbeat
+        self.last_answer: Optional[float] = None
+        self.last_round_trip = 0.0
+
+    def sample(self) -> Optional[TickSample]:
+        start = time.monotonic()
+        output = self.server.send_command(self.command, FORGE_TPS_MSG, timeout=10)
+        self.last_answer = time.monotonic()
+        self.last_round_trip = self.last_answer - start
+        match = FORGE_TPS_MSG.search(output)
+        if not match:
+            self.logger.warning(f'Could not parse tick times from: {output}')
+            return None
+        sample: TickSample = {
+            'time': datetime.datetime.now().timestamp(),
+            'mspt': float(match.group(1)),
+            'tps': float(match.group(2))
+        }
+        self.samples.append(sample)
+        _mspt.set(sample['mspt'], instance=self.name)
+        _tps.set(sample['tps'], instance=self.name)
+        return sample
+
+    def update(self, interval: float) -> float:
+        # Scheduler task, a failed sample should not stop sampling
+        try:
+            if self.sample():
+                self.failures = 0
+                return interval
+        except Exception:
+            self.logger.exception('Failed to sample tick times')
+        self.failures += 1
+        if self.failures >= MAX_FAILURES:
+            self.logger.warning(f'"{self.command}" keeps failing, sampling tick times less often')
+            return interval * BACKOFF_FACTOR
+        return interval
+
+    def mean_mspt(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        return sum(s['mspt'] for s in self.samples) / len(self.samples)
+
+    def load(self) -> float:
+        # 1.0 means the server is using its whole tick budget
+        mspt = self.mean_mspt()
+        return mspt / TICK_MS if mspt is not None else 0.0
+
+    def is_lagging(self) -> bool:
+        mspt = self.mean_mspt()
+        return mspt is not None and mspt >= self.lag_mspt
@@ -0,0 +1,206 @@
+from typing import Optional, Callable, Dict, Tuple, Set
+import os
+import time
+import hashlib
+import threading
+import logging
+
+import archive
+import backup
+import chunk_store
+import metrics
+from backup_worker import apply_priority, Priority, IOPRIO_CLASS_IDLE
+from chunk_store import split_region, HEADER_SIZE
+from registry import BackupRegistry, VerifyItem
+
+INTERVAL = 5 * 60
+# Files are checked again once their last check is this old
+RECHECK_AGE = 7 * 24 * 60 * 60
+BATCH_SIZE = 64
+PRIORITY: Priority = (19, IOPRIO_CLASS_IDLE, 7)
+
+_verified_files = metrics.counter('backup_verified_files_total', 'Backed up files checked by the verifier')
+_verified_bytes = metrics.counter('backup_verified_bytes_total', 'Bytes read by the backup verifier')
+_verify_failures = metrics.counter('backup_verify_failures_total', 'Backed up files that failed verification')
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def check_region(data: bytes) -> Optional[str]:
+    # Empty region files are normal, anything else needs a full header and valid chunk offsets
+    if not data:
+        return None
+    if len(data) < HEADER_SIZE:
+        return 'truncated region header'
+    if split_region(data) is None:
+        return 'region chunk points past the end of the file'
+    return None
+
+
+def check_file(path: str, data: bytes, expected: Optional[str]) -> Optional[str]:
+    if expected and _sha256(data) != expected:
+        return 'hash mismatch'
+    if path.endswith('.mca'):
+        return check_region(data)
+    return None
+
+
+class BackupVerifier:
+    def __init__(self, registry: BackupRegistry, bytes_per_hour: float,
+                 paused: Optional[Callable[[], bool]] = None, name: str = '') -> None:
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.registry = registry
+        self.bytes_per_hour = bytes_per_hour
+        self.paused = paused
+        self._budget = 0.0
+        self._budget_lock = threading.Lock()
+        self._last = time.monotonic()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._manifests: Dict[int, Dict[str, chunk_store.FileEntry]] = {}
+
+    def update(self, interval: float) -> float:
+        # Scheduler task. The checking itself runs on a low priority thread
+        now = time.monotonic()
+        with self._budget_lock:
+            self._budget = min(self._budget + self.bytes_per_hour * (now - self._last) / 3600, self.bytes_per_hour)
+            self._last = now
+            budget = self._budget
+        if self._thread and self._thread.is_alive():
+            return interval
+        if budget <= 0 or (self.paused and self.paused()):
+            return interval
+        self._thread = threading.Thread(target=self._run, args=(budget,), daemon=True)
+        self._thread.start()
+        return interval
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._thread:
+            self._thread.join()
+
+    def _run(self, budget: float) -> None:
+        apply_priority(PRIORITY)
+        try:
+            spent = self.verify(budget)
+            with self._budget_lock:
+                self._budget -= spent
+        except Exception:
+            self.logger.exception('Backup verification failed')
+
+    def verify(self, budget: float) -> int:
+        # Returns the bytes read. A big file can take the budget below zero, later runs wait
+        # for it to refill
+        spent = 0
+        self._manifests = {}
+        done: Set[Tuple[int, str]] = set()
+        while spent < budget and not self._stopped:
+            items = self.registry.files_to_verify(time.time() - RECHECK_AGE, BATCH_SIZE)
+            items = [i for i in items if (i['backup_id'], i['path']) not in done]
+            if not items:
+                break
+            for item in items:
+                if spent >= budget or self._stopped:
+                    break
+                if item['mode'] == backup.MODE_ARCHIVE:
+                    read, results = self._verify_archive(item)
+                else:
+                    read, failure = self._verify_item(item)
+                    results = {item['path']: failure}
+                spent += read
+                self._record(item, results)
+                done.update((item['backup_id'], path) for path in results)
+        return spent
+
+    def _record(self, item: VerifyItem, results: Dict[str, Optional[str]]) -> None:
+        now = time.time()
+        failed = {path: reason for path, reason in results.items() if reason}
+        ok = [path for path, reason in results.items() if not reason]
+        self.registry.mark_verified(item['backup_id'], ok, now, True)
+        self.registry.mark_verified(item['backup_id'], failed, now, False)
+        _verified_files.inc(len(results), instance=self.name)
+        for path, reason in failed.items():
+            _verify_failures.inc(reason=reason, instance=self.name)
+            self.logger.error(f'Backup {item["day_path"]}/{item["backup_path"]} failed verification: {path}: {reason}')
+
+    def _backup_dir(self, item: VerifyItem) -> str:
+        return os.path.join(self.registry.backup_path, item['day_path'], item['backup_path'])
+
+    def _verify_item(self, item: VerifyItem) -> Tuple[int, Optional[str]]:
+        try:
+            if item['mode'] == backup.MODE_CHUNKED:
+                return self._verify_chunked(item)
+            with open(os.path.join(self._backup_dir(item), item['path']), 'rb') as input:
+                data = input.read()
+        except FileNotFoundError:
+            if self.registry.backup(item['backup_id']) is None:
+                return 0, None  # Pruned while it was being checked
+            return 0, 'missing'
+        backup.throttle(len(data))
+        _verified_bytes.inc(len(data), instance=self.name)
+        return len(data), check_file(item['path'], data, item['hash'])
+
+    def _verify_chunked(self, item: VerifyItem) -> Tuple[int, Optional[str]]:
+        entries = self._manifests.get(item['backup_id'])
+        if entries is None:
+            manifest = chunk_store.load_manifest(self._backup_dir(item))
+            if manifest is None:
+                return 0, 'missing manifest'
+            # Manifest paths do not include the world name
+            world = item['path'].split(os.sep)[0]
+            entries = {os.path.join(world, e['path']): e for e in manifest['files']}
+            self._manifests[item['backup_id']] = entries
+        entry = entries.get(item['path'])
+        if entry is None:
+            return 0, 'missing from manifest'
+
+        store_dir = os.path.join(self.registry.backup_path, chunk_store.STORE_DIR)
+        if entry['blob']:
+            # Blobs are named by their hash, so a plain file's blob is its hash
+            if item['hash'] and entry['blob'] != item['hash']:
+                return 0, 'manifest does not match the recorded hash'
+            keys = [entry['blob']]
+        else:
+            keys = [entry['header']] + [key for _, key in entry['chunks']]
+        read = 0
+        for key in keys:
+            try:
+                data = chunk_store.read_blob(store_dir, key)
+            except FileNotFoundError:
+                return read, 'missing chunk'
+            read += len(data)
+            backup.throttle(len(data))
+            _verified_bytes.inc(len(data), instance=self.name)
+            if _sha256(data) != key:
+                return read, 'corrupt chunk'
+        return read, None
+
+    def _verify_archive(self, item: VerifyItem) -> Tuple[int, Dict[str, Optional[str]]]:
+        # Archives can only be read front to back, so the whole backup is checked at once
+        backup_dir = self._backup_dir(item)
+        expected = {f: r['hash'] for f, r in self.registry.files(item['backup_id']).items()}
+        results: Dict[str, Optional[str]] = {}
+        read = 0
+        try:
+            names = sorted(os.listdir(backup_dir))
+        except FileNotFoundError:
+            return 0, {} if self.registry.backup(item['backup_id']) is None else {item['path']: 'missing'}
+        for name in names:
+            path = os.path.join(backup_dir, name)
+            try:
+                size = os.path.getsize(path)
+                backup.throttle(size)
+                read += size
+                for rel, data in archive.read_archive(path, lambda rel: rel in expected):
+                    results[rel] = check_file(rel, data, expected[rel])
+            except Exception as e:
+                # Whatever could not be read is reported as missing below
+                self.logger.error(f'Could not read {path}: {e}')
+        _verified_bytes.inc(read, instance=self.name)
+        for rel in expected:
+            results.setdefault(rel, 'missing from archive')
+        return read, results
+
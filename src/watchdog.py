@@ -0,0 +1,231 @@
+from typing import TypedDict, Optional, List, Dict, Deque, Any
+import collections
+import datetime
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+import metrics
+
+# Log lines kept for the stall report
+RECENT_LINES = 200
+DUMP_TIMEOUT = 30
+# Time a stalled server gets to exit on SIGTERM before it is killed
+KILL_GRACE = 30
+
+_heartbeat_seconds = metrics.histogram(
+    'server_heartbeat_seconds', 'Round trip of the watchdog heartbeat command',
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+_heartbeat_failures = metrics.counter('server_heartbeat_failures_total', 'Watchdog heartbeats that failed or timed out')
+_log_silence = metrics.gauge('server_log_silence_seconds', 'Seconds since the server last wrote a log line')
+_cpu_percent = metrics.gauge('server_cpu_percent', 'CPU use of the server process and its children')
+_rss_bytes = metrics.gauge('server_rss_bytes', 'Resident memory of the server process and its children')
+_stalls = metrics.counter('server_stalls_total', 'Times the watchdog found the server stalled and killed it')
+
+
+class Health(TypedDict):
+    time: float
+    heartbeat: Optional[float]  # Round trip in seconds, None if it failed
+    failures: int  # Heartbeats failed in a row
+    log_silence: float
+    cpu_percent: Optional[float]  # None without psutil
+    rss: Optional[int]
+
+
+class Watchdog:
+    def __init__(self, server, timeout: float, max_failures: int, log_silence: float, dump_dir: str,
+                 name: str = '') -> None:
+        self.logger = logging.getLogger(__name__)
+        self.server = server
+        self.name = name
+        self.timeout = timeout
+        self.max_failures = max(1, max_failures)
+        self.log_silence = log_silence
+        self.dump_dir = dump_dir
+        self.failures = 0
+        self.last: Optional[Health] = None
+        self._last_line = time.monotonic()
+        self._last_check: Optional[float] = None
+        self._recent: Deque[str] = collections.deque(maxlen=RECENT_LINES)
+        self._processes: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+        server.server_log.subscribe(self._on_line)
+
+    def detach(self) -> None:
+        self.server.server_log.unsubscribe(self._on_line)
+
+    def _on_line(self, line: str) -> None:
+        with self._lock:
+            self._last_line = time.monotonic()
+            self._recent.append(line)
+
+    def silence(self) -> float:
+        with self._lock:
+            return time.monotonic() - self._last_line
+
+    def heartbeat(self) -> Optional[float]:
+        # A tick sample answered since the last check already shows the server is responsive, so
+        # nothing extra is sent. Otherwise list is sent, which answers on every server version
+        # and keeps the player list in sync while at it
+        ticks = self.server.ticks
+        since = self._last_check
+        self._last_check = time.monotonic()
+        if ticks.last_answer is not None and since is not None and ticks.last_answer > since:
+            _heartbeat_seconds.observe(ticks.last_round_trip, instance=self.name)
+            return ticks.last_round_trip
+        start = time.monotonic()
+        try:
+            self.server.sync_players(self.timeout)
+        except Exception as e:
+            _heartbeat_failures.inc(instance=self.name)
+            self.logger.warning(f'Heartbeat failed: {e}')
+            return None
+        elapsed = time.monotonic() - start
+        _heartbeat_seconds.observe(elapsed, instance=self.name)
+        return elapsed
+
+    def _tree(self) -> List[Any]:
+        # The start command may be a wrapper script, so children count too. Process objects are
+        # kept between checks since cpu_percent measures from the previous call
+        root = self._processes.get(self.server.process.pid)
+        if root is None:
+            root = psutil.Process(self.server.process.pid)
+            root.cpu_percent(None)
+        processes = {root.pid: root}
+        for child in root.children(recursive=True):
+            processes[child.pid] = self._processes.get(child.pid, child)
+        self._processes = processes
+        return list(processes.values())
+
+    def _usage(self) -> Dict[str, Any]:
+        if psutil is None:
+            return {'cpu_percent': None, 'rss': None}
+        cpu = 0.0
+        rss = 0
+        try:
+            for process in self._tree():
+                try:
+                    cpu += process.cpu_percent(None)
+                    rss += process.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+        except psutil.NoSuchProcess:
+            return {'cpu_percent': None, 'rss': None}
+        _cpu_percent.set(cpu, instance=self.name)
+        _rss_bytes.set(rss, instance=self.name)
+        return {'cpu_percent': cpu, 'rss': rss}
+
+    def check(self) -> Health:
+        heartbeat = self.heartbeat()
+        self.failures = 0 if heartbeat is not None else self.failures + 1
+        silence = self.silence()
+        _log_silence.set(silence, instance=self.name)
+        health: Health = {
+            'time': datetime.datetime.now().timestamp(),
+            'heartbeat': heartbeat,
+            'failures': self.failures,
+            'log_silence': silence,
+            **self._usage()
+        }
+        self.last = health
+        return health
+
+    def stalled(self, health: Health) -> bool:
+        # A quiet log alone is normal on an empty server, but not when the heartbeat fails as well
+        if health['failures'] >= self.max_failures:
+            return True
+        return health['failures'] > 0 and self.log_silence > 0 and health['log_silence'] >= self.log_silence
+
+    def update(self, interval: float) -> float:
+        # Scheduler task
+        if not self.server.server_alive():
+            return interval
+        health = self.check()
+        if self.stalled(health):
+            self.recover(health)
+        return interval
+
+    def _jvm_pid(self) -> int:
+        if psutil is not None:
+            try:
+                for process in self._tree():
+                    if 'java' in process.name():
+                        return process.pid
+            except psutil.NoSuchProcess:
+                pass
+        return self.server.process.pid
+
+    def _thread_dump(self, pid: int) -> str:
+        jstack = shutil.which('jstack')
+        if jstack:
+            try:
+                result = subprocess.run(
+                    [jstack, '-l', str(pid)], capture_output=True, text=True, timeout=DUMP_TIMEOUT
+                )
+                if result.returncode == 0:
+                    return result.stdout
+                self.logger.warning(f'jstack failed: {result.stderr.strip()}')
+            except subprocess.TimeoutExpired:
+                self.logger.warning(f'jstack did not finish in {DUMP_TIMEOUT}s')
+        # The JVM prints its threads to its console on SIGQUIT. That only ends up somewhere
+        # when log_source is stdout
+        try:
+            os.kill(pid, signal.SIGQUIT)
+        except OSError as e:
+            return f'Could not request a thread dump: {e}\n'
+        return 'jstack unavailable, sent SIGQUIT. The dump is in the server console\n'
+
+    def capture(self, health: Health) -> Optional[str]:
+        # Written before the server is killed, returns the report path
+        pid = self._jvm_pid()
+        stamp = datetime.datetime.fromtimestamp(health['time']).strftime('%Y-%m-%d_%H-%M-%S')
+        path = os.path.join(self.dump_dir, f'stall_{stamp}.txt')
+        with self._lock:
+            recent = list(self._recent)
+        try:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            with open(path, 'w') as out:
+                out.write(f'Server pid {self.server.process.pid}, JVM pid {pid}\n')
+                for key, value in health.items():
+                    out.write(f'{key}: {value}\n')
+                out.write('\n--- Thread dump ---\n')
+                out.write(self._thread_dump(pid))
+                out.write(f'\n--- Last {len(recent)} log lines ---\n')
+                out.writelines(line if line.endswith('\n') else line + '\n' for line in recent)
+        except Exception:
+            self.logger.exception('Failed to write stall report')
+            return None
+        return path
+
+    def recover(self, health: Health) -> None:
+        # Killing the process ends this run of the scheduler and the supervisor starts a new one
+        _stalls.inc(instance=self.name)
+        self.logger.error(
+            f'Server stalled: {health["failures"]} failed heartbeats, no log output for '
+            f'{health["log_silence"]:.0f}s, cpu {health["cpu_percent"]}%, rss {health["rss"]}'
+        )
+        path = self.capture(health)
+        if path:
+            self.logger.error(f'Wrote stall report to {path}')
+
+        process = self.server.process
+        process.terminate()
+        try:
+            process.wait(KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            self.logger.error(f'Server did not exit {KILL_GRACE}s after SIGTERM, killing it')
+            process.kill()
+            process.wait()
+
+    def summary(self) -> Dict[str, Any]:
+        return {'failures': self.failures, 'last_check': self.last}
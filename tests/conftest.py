@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The manager runs its modules from src/ as top level modules, the fakes live in bench/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
@@ -0,0 +1,53 @@
+import errno
+import os
+
+import pytest
+
+import copy_engine
+from copy_engine import CopyEngine
+
+
+def write(path: str, size: int) -> bytes:
+    data = os.urandom(size)
+    with open(path, 'wb') as out:
+        out.write(data)
+    return data
+
+
+@pytest.mark.parametrize('error', [errno.EXDEV, errno.EOPNOTSUPP])
+def test_failed_clone_falls_back_to_copying(tmp_path, monkeypatch, error):
+    calls = []
+
+    def ioctl(fd, request, arg):
+        calls.append(request)
+        raise OSError(error, os.strerror(error))
+
+    monkeypatch.setattr(copy_engine.fcntl, 'ioctl', ioctl)
+    engine = CopyEngine(reflink=True)
+    for i, size in enumerate([3 * copy_engine.CHUNK_SIZE // 2, 4096, 0]):
+        data = write(tmp_path / f'src{i}', size)
+        copied, _ = engine.copy_file(str(tmp_path / f'src{i}'), str(tmp_path / f'dst{i}'))
+        assert copied == size
+        assert (tmp_path / f'dst{i}').read_bytes() == data
+
+    # Only the first copy tries to clone, the engine stays on plain copies after that
+    assert calls == [copy_engine.FICLONE]
+    assert not engine.reflink
+
+
+def test_supports_reflink_is_false_when_clone_fails(tmp_path, monkeypatch):
+    def ioctl(fd, request, arg):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+    monkeypatch.setattr(copy_engine.fcntl, 'ioctl', ioctl)
+    assert not copy_engine.supports_reflink(str(tmp_path))
+
+
+def test_other_clone_errors_are_raised(tmp_path, monkeypatch):
+    def ioctl(fd, request, arg):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    monkeypatch.setattr(copy_engine.fcntl, 'ioctl', ioctl)
+    write(tmp_path / 'src', 4096)
+    with pytest.raises(OSError):
+        CopyEngine(reflink=True).copy_file(str(tmp_path / 'src'), str(tmp_path / 'dst'))
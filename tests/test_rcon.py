@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from fake_rcon import RconServer
+from rcon import RconClient, RconError
+
+PASSWORD = 'secret'
+
+
+def start(**kwargs) -> RconServer:
+    server = RconServer(0, PASSWORD, **kwargs)
+    server.start()
+    return server
+
+
+def client(server: RconServer, timeout: float = 5) -> RconClient:
+    return RconClient('127.0.0.1', server.port, PASSWORD, timeout)
+
+
+def test_multi_packet_response_is_reassembled():
+    server = start()
+    rcon = client(server)
+    try:
+        listed, big, said = rcon.commands(['list', 'big', 'say hi'])
+    finally:
+        rcon.close()
+        server.stop()
+    assert listed == 'There are 0/20 players online:'
+    assert big == ''.join(f'line {i}\n' for i in range(2000))
+    assert said == 'Ran say hi'
+
+
+def test_reconnects_after_idle_close():
+    server = start(close_idle=True)
+    rcon = client(server)
+    try:
+        assert rcon.command('summon creeper') == 'Ran summon creeper'
+        # The server drops the connection once it has been quiet for a moment
+        time.sleep(0.5)
+        assert rcon.command('summon zombie') == 'Ran summon zombie'
+    finally:
+        rcon.close()
+        server.stop()
+    assert server.ran == ['summon creeper', 'summon zombie']
+
+
+def test_batch_is_not_resent_after_it_was_sent():
+    server = start(drop_after=1)
+    rcon = client(server)
+    try:
+        with pytest.raises(RconError):
+            rcon.commands(['give Alice diamond', 'summon creeper'])
+        time.sleep(0.2)
+    finally:
+        rcon.close()
+        server.stop()
+    assert server.ran == ['give Alice diamond', 'summon creeper']
+
+
+def test_timeout_is_not_retried():
+    server = start(delay=1)
+    rcon = client(server, timeout=0.2)
+    try:
+        with pytest.raises(RconError, match='timed out'):
+            rcon.command('save-all')
+        time.sleep(1.2)
+    finally:
+        rcon.close()
+        server.stop()
+    assert server.ran == ['save-all']
+
+
+def test_bad_password_fails():
+    server = start()
+    rcon = RconClient('127.0.0.1', server.port, 'wrong', 5)
+    try:
+        with pytest.raises(RconError, match='authentication failed'):
+            rcon.command('list')
+    finally:
+        rcon.close()
+        server.stop()
+    assert server.ran == []
@@ -0,0 +1,49 @@
+import os
+
+import backup
+from retention import DEFAULT_RETENTION, GB, select
+
+MB = 1024 * 1024
+
+
+def record(id: int, path: str, bytes: int, mode: str = 'incremental'):
+    # One backup a day apart, newest has the highest id
+    return {
+        'id': id, 'day_id': id, 'day_path': 'day', 'path': path, 'time': 1700000000 + id * 86400,
+        'mode': mode, 'bytes': bytes, 'complete': 1
+    }
+
+
+def policy(max_total_mb: float):
+    return {**DEFAULT_RETENTION, 'last': 100, 'max_total_gb': max_total_mb * MB / GB}
+
+
+def test_cap_without_footprint_sums_added_bytes():
+    backups = [record(i, str(i), 10 * MB) for i in range(1, 6)]
+    assert select(backups, policy(35)) == {5, 4, 3}
+
+
+def test_shared_storage_is_counted_once():
+    # Each backup references the same 30 MB world plus 1 MB of its own. bytes only shows what it
+    # added, which would let the cap pass while the kept backups really need 30 MB more
+    backups = [record(1, '1', 31 * MB)] + [record(i, str(i), 1 * MB) for i in range(2, 6)]
+    usage = {b['id']: {'world': 30 * MB, b['id']: 1 * MB} for b in backups}
+    assert select(backups, policy(40)) == {1, 2, 3, 4, 5}
+    assert select(backups, policy(33), lambda b: usage[b['id']]) == {5, 4, 3}
+
+
+def test_footprint_counts_hard_links_once(tmp_path):
+    world = os.urandom(MB)
+    for name in ('1', '2'):
+        os.makedirs(tmp_path / 'day' / name)
+    with open(tmp_path / 'day' / '1' / 'r.0.0.mca', 'wb') as out:
+        out.write(world)
+    os.link(tmp_path / 'day' / '1' / 'r.0.0.mca', tmp_path / 'day' / '2' / 'r.0.0.mca')
+    with open(tmp_path / 'day' / '2' / 'level.dat', 'wb') as out:
+        out.write(os.urandom(4096))
+
+    backups = [record(1, '1', MB), record(2, '2', 4096)]
+    measure = backup._footprint(str(tmp_path), backups)
+    shared = set(measure(backups[0])) & set(measure(backups[1]))
+    assert len(shared) == 1
+    assert sum(measure(backups[1]).values()) >= MB + 4096
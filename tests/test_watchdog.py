@@ -0,0 +1,81 @@
+import copy
+import glob
+import os
+import sys
+import time
+
+import server
+import watchdog
+from instance import Instance
+from readiness import Readiness
+from server import Server
+from server_config import DEFAULT_CONFIG, Config
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'fake_server.py')
+FAILURES = 2
+
+
+def hanging_config(root: str, hang_after: int) -> Config:
+    config: Config = copy.deepcopy(DEFAULT_CONFIG)
+    server_path = os.path.join(root, 'server')
+    config.update({
+        'name': 'watchdog',
+        'server_path': server_path,
+        'save_path': os.path.join(server_path, 'world'),
+        'start_command': [
+            sys.executable, FAKE_SERVER, '--startup', '0.2', '--world-mb', '1', '--no-echo',
+            '--hang-after', str(hang_after)
+        ],
+        'backup_path': os.path.join(root, 'backups'),
+        'backup_verify_mb_per_hour': 0,
+        'watchdog_timeout': 1,
+        'watchdog_failures': FAILURES,
+        'watchdog_log_silence': 0
+    })
+    return config
+
+
+def test_hung_server_is_dumped_and_killed(tmp_path, monkeypatch):
+    # Its own control socket, so a manager running from this checkout is left alone
+    monkeypatch.setattr(server, 'control_socket', lambda name: str(tmp_path / 'control.sock'))
+    monkeypatch.setattr(watchdog, 'KILL_GRACE', 2)
+    config = hanging_config(str(tmp_path), 1)
+    os.makedirs(config['server_path'])
+    instance = Instance(config)
+    launched = time.monotonic()
+    process = instance.start_game()
+    logs = instance.open_logs(process, None)
+    readiness = Readiness(logs, process, launched, config['name'])
+    logs.start()
+    minecraft = None
+    try:
+        minecraft = Server(config, process, logs)
+        readiness.wait(config['startup_timeout'])
+        dump_dir = minecraft.watchdog.dump_dir
+
+        # Answered, then the server stops answering but stays up
+        minecraft.watchdog.update(1)
+        assert minecraft.watchdog.failures == 0
+        for failures in range(1, FAILURES):
+            minecraft.watchdog.update(1)
+            assert minecraft.watchdog.failures == failures
+            assert process.poll() is None
+            assert not glob.glob(os.path.join(dump_dir, 'stall_*.txt'))
+
+        minecraft.watchdog.update(1)
+        assert minecraft.watchdog.failures == FAILURES
+        assert process.poll() is not None
+        dumps = glob.glob(os.path.join(dump_dir, 'stall_*.txt'))
+        assert len(dumps) == 1
+        with open(dumps[0]) as report:
+            text = report.read()
+        assert f'Server pid {process.pid}' in text
+        assert f'failures: {FAILURES}' in text
+        assert 'Done' in text
+        assert watchdog._stalls.value(instance=config['name']) == 1
+        assert watchdog._heartbeat_failures.value(instance=config['name']) == FAILURES
+    finally:
+        process.kill()
+        if minecraft:
+            minecraft.stop()
+        logs.stop()